@@ -2,14 +2,14 @@
 import os
 import json
 import time
-import asyncio
 from typing import Set, List
 
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+from broadcast import broadcasts
 
 ADMIN_ROUTER = Router()
 _START_TS = time.time()
@@ -114,16 +114,6 @@ def _uptime() -> str:
     return f"{h:02d}:{m:02d}:{s:02d}"
 
 
-async def _send_safe(bot, chat_id: int, text: str) -> bool:
-    try:
-        await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
-        return True
-    except (TelegramForbiddenError, TelegramBadRequest):
-        return False
-    except Exception:
-        return False
-
-
 # ----------------------------
 # Команды
 # ----------------------------
@@ -216,27 +206,12 @@ async def cmd_broadcast(message: Message):
         await message.answer("Использование: <code>/broadcast ТЕКСТ</code>", parse_mode=ParseMode.HTML)
         return
 
-    users = get_all_users()
     banned = get_banned()
+    users = [uid for uid in get_all_users() if uid not in banned]
 
-    ok = 0
-    fail = 0
-
-    await message.answer(f"📣 Начинаю рассылку… Пользователей: <b>{len(users)}</b>", parse_mode=ParseMode.HTML)
-
-    for uid in users:
-        if uid in banned:
-            continue
-        sent = await _send_safe(message.bot, uid, f"📣 <b>Сообщение от администратора</b>\n\n{payload}")
-        if sent:
-            ok += 1
-        else:
-            fail += 1
-        await asyncio.sleep(0.05)
-
-    await message.answer(
-        "✅ <b>Рассылка завершена</b>\n\n"
-        f"Отправлено: <b>{ok}</b>\n"
-        f"Не доставлено: <b>{fail}</b>",
-        parse_mode=ParseMode.HTML
+    await broadcasts.start(
+        message.bot,
+        f"📣 <b>Сообщение от администратора</b>\n\n{payload}",
+        users,
+        admin_chat_id=message.chat.id,
     )
@@ -174,7 +174,47 @@ AUTHORS: Dict[str, Dict[str, Any]] = {
 }
 
 
-def list_author_keys() -> List[str]:
+# =========================
+# Версия реестра: всё, что построено по AUTHORS (порядок, группы, клавиатуры),
+# кэшируется до следующего изменения реестра
+# =========================
+_registry_version = 0
+_derived: Dict[str, Any] = {}
+_derived_version = -1
+
+
+def registry_version() -> int:
+    return _registry_version
+
+
+def registry_changed() -> None:
+    """Вызывать после любой правки AUTHORS на месте — сбрасывает кэши."""
+    global _registry_version
+    _registry_version += 1
+    _derived.clear()
+
+
+def register_author(author_key: str, data: Dict[str, Any]) -> None:
+    AUTHORS[author_key] = data
+    registry_changed()
+
+
+def unregister_author(author_key: str) -> None:
+    if AUTHORS.pop(author_key, None) is not None:
+        registry_changed()
+
+
+def _cached(name: str, build):
+    global _derived_version
+    if _derived_version != _registry_version:
+        _derived.clear()
+        _derived_version = _registry_version
+    if name not in _derived:
+        _derived[name] = build()
+    return _derived[name]
+
+
+def _sorted_keys() -> tuple:
     def rank(group: str) -> int:
         try:
             return GROUP_ORDER.index(group)
@@ -183,18 +223,34 @@ def list_author_keys() -> List[str]:
 
     items = list(AUTHORS.items())
     items.sort(key=lambda kv: (rank(kv[1].get("group", "")), kv[1].get("name", kv[0])))
-    return [k for k, _ in items]
+    return tuple(k for k, _ in items)
 
 
-def get_groups() -> List[str]:
+def list_author_keys() -> List[str]:
+    return list(_cached("keys", _sorted_keys))
+
+
+def _groups() -> tuple:
     groups = {a.get("group") for a in AUTHORS.values() if a.get("group")}
-    return [g for g in GROUP_ORDER if g in groups] + sorted([g for g in groups if g not in GROUP_ORDER])
+    return tuple([g for g in GROUP_ORDER if g in groups] + sorted([g for g in groups if g not in GROUP_ORDER]))
+
+
+def get_groups() -> List[str]:
+    return list(_cached("groups", _groups))
 
 
 def get_authors_by_group(group: str) -> Dict[str, str]:
-    pairs = [(k, v.get("name", k)) for k, v in AUTHORS.items() if v.get("group") == group]
-    pairs.sort(key=lambda x: x[1])
-    return dict(pairs)
+    # group приходит из callback_data — кэшируем только существующие группы,
+    # иначе поддельные значения раздули бы кэш без ограничений
+    if group not in get_groups():
+        return {}
+
+    def build() -> tuple:
+        pairs = [(k, v.get("name", k)) for k, v in AUTHORS.items() if v.get("group") == group]
+        pairs.sort(key=lambda x: x[1])
+        return tuple(pairs)
+
+    return dict(_cached(f"group:{group}", build))
 
 
 def get_author(author_key: str) -> Dict[str, Any]:
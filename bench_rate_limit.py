@@ -0,0 +1,261 @@
+# bench_rate_limit.py
+# Бенчмарк антифлуда: прежний лимитер на очередях меток времени против кольца меток + GCRA бюджета
+# на миллионе разных пользователей — память, стоимость check() и очистки простаивающих.
+# Плюс сверка поведения на типичных сценариях (пачка, ровный поток, AI-запросы)
+# и ожидание по стоимости запросов: короткий чат против длинного соавторства,
+# и граница окна: в любое окно per_seconds проходит не больше max_messages, как у прежнего окна.
+#
+# Запуск:
+#   python bench_rate_limit.py
+#   python bench_rate_limit.py --users 200000 --out bench_output.txt
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import platform
+import time
+import tracemalloc
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from rate_limit import InMemoryRateLimiter, RateLimitConfig, estimate_cost
+
+DEFAULT_USERS = 1_000_000
+MESSAGES_PER_USER = 3
+
+# Прежний отдельный лимит на "тяжёлые" сообщения: 3 за 20 секунд
+LEGACY_MAX_AI = 3
+LEGACY_AI_PER_SECONDS = 20
+
+# Оценочная стоимость сообщений из сценариев
+SHORT_CHAT = estimate_cost("x" * 60, "chat")
+LONG_CHAT = estimate_cost("x" * 600, "chat")
+LONG_COWRITE = estimate_cost("x" * 4000, "cowrite")
+
+
+class LegacyRateLimiter:
+    """
+    Прежний InMemoryRateLimiter: очередь меток времени на пользователя, cooldown не чистится.
+    "Тяжёлое" сообщение (длинное или с ключевыми словами) — любое с ненулевой стоимостью.
+    """
+
+    def __init__(self, cfg: RateLimitConfig):
+        self.cfg = cfg
+        self._bucket: Dict[int, Deque[float]] = {}
+        self._bucket_ai: Dict[int, Deque[float]] = {}
+        self._cooldown_until: Dict[int, float] = {}
+        self.now = 0.0
+
+    def _now(self) -> float:
+        return self.now
+
+    def _get_deque(self, store: Dict[int, Deque[float]], user_id: int) -> Deque[float]:
+        if user_id not in store:
+            store[user_id] = deque()
+        return store[user_id]
+
+    @staticmethod
+    def _prune(q: Deque[float], window: int, now: float) -> None:
+        while q and (now - q[0]) > window:
+            q.popleft()
+
+    def check(self, user_id: int, cost: float = 0.0) -> Optional[int]:
+        is_ai = cost > 0
+        now = self._now()
+        cd = self._cooldown_until.get(user_id)
+        if cd and now < cd:
+            return int(cd - now) + 1
+        q = self._get_deque(self._bucket, user_id)
+        self._prune(q, self.cfg.per_seconds, now)
+        if len(q) >= self.cfg.max_messages:
+            self._cooldown_until[user_id] = now + self.cfg.cooldown_seconds
+            return self.cfg.cooldown_seconds
+        if is_ai:
+            qa = self._get_deque(self._bucket_ai, user_id)
+            self._prune(qa, LEGACY_AI_PER_SECONDS, now)
+            if len(qa) >= LEGACY_MAX_AI:
+                self._cooldown_until[user_id] = now + self.cfg.cooldown_seconds
+                return self.cfg.cooldown_seconds
+        q.append(now)
+        if is_ai:
+            self._get_deque(self._bucket_ai, user_id).append(now)
+        return None
+
+
+class _ClockedLimiter(InMemoryRateLimiter):
+    """InMemoryRateLimiter с ручными часами — чтобы сценарии и очистка не зависели от реального времени."""
+
+    now = 0.0
+
+    def _now(self) -> float:
+        return self.now
+
+
+# =========================
+# Поведение
+# =========================
+# (название, [(смещение от начала в сек, стоимость), ...])
+SCENARIOS: List[Tuple[str, List[Tuple[float, float]]]] = [
+    ("пачка из 6", [(0.0, 0.0)] * 6),
+    ("пачка из 7", [(0.0, 0.0)] * 7),
+    ("3 коротких вопроса подряд", [(0.0, SHORT_CHAT)] * 3),
+    ("4 коротких вопроса подряд", [(0.0, SHORT_CHAT)] * 4),
+    ("длинный вопрос раз в 5 сек", [(i * 5.0, LONG_CHAT) for i in range(6)]),
+    ("соавторство 4000 симв. раз в 5 сек", [(i * 5.0, LONG_COWRITE) for i in range(6)]),
+    ("раз в 2 сек", [(i * 2.0, 0.0) for i in range(20)]),
+    ("раз в секунду", [(float(i), 0.0) for i in range(20)]),
+    ("после cooldown", [(0.0, 0.0)] * 7 + [(13.0, 0.0)]),
+]
+
+
+def behavior(cfg: RateLimitConfig) -> Dict[str, Dict[str, object]]:
+    out: Dict[str, Dict[str, object]] = {}
+    for name, events in SCENARIOS:
+        row: Dict[str, object] = {}
+        for label, limiter in (("legacy", LegacyRateLimiter(cfg)), ("ring", _ClockedLimiter(cfg))):
+            verdicts = []
+            for t, cost in events:
+                limiter.now = 1000.0 + t
+                wait = limiter.check(1, cost)
+                verdicts.append("ok" if wait is None else f"wait{wait}")
+            row[label] = " ".join(verdicts)
+        row["same"] = row["legacy"] == row["ring"]
+        out[name] = row
+    return out
+
+
+def window_bound(cfg: RateLimitConfig, seconds: float = 60.0) -> Dict[str, object]:
+    """
+    Граница окна: пачка из max_messages, затем сообщения чуть медленнее среднего темпа.
+    Сколько прошло и сколько максимум пришлось на одно окно per_seconds.
+    """
+    interval = cfg.per_seconds / cfg.max_messages + 0.01
+    times = [0.0] * cfg.max_messages
+    t = interval
+    while t < seconds:
+        times.append(t)
+        t += interval
+
+    out: Dict[str, object] = {"max_messages": cfg.max_messages, "per_seconds": cfg.per_seconds}
+    for label, limiter in (("legacy", LegacyRateLimiter(cfg)), ("ring", _ClockedLimiter(cfg))):
+        accepted = []
+        for t in times:
+            limiter.now = 1000.0 + t
+            if limiter.check(1, 0.0) is None:
+                accepted.append(t)
+        in_window = max(
+            sum(1 for x in accepted if start <= x < start + cfg.per_seconds) for start in accepted
+        ) if accepted else 0
+        out[label] = {"accepted": len(accepted), "sent": len(times), "max_in_window": in_window}
+    assert out["ring"]["max_in_window"] <= cfg.max_messages, out
+    return out
+
+
+def cost_waits(cfg: RateLimitConfig, messages: int = 8) -> Dict[str, object]:
+    """
+    Поток одинаковых сообщений вплотную (каждое — сразу как разрешили):
+    сколько прошло без ожидания и сколько сообщений в минуту выходит в установившемся режиме.
+    """
+    out: Dict[str, object] = {}
+    for name, cost in (("короткий чат", SHORT_CHAT), ("длинный чат", LONG_CHAT), ("соавторство 4000 симв.", LONG_COWRITE)):
+        limiter = _ClockedLimiter(cfg)
+        limiter.now = 1000.0
+        free, waits = 0, []
+        for _ in range(messages):
+            wait = limiter.check(1, cost)
+            while wait is not None:
+                waits.append(wait)
+                limiter.now += wait
+                wait = limiter.check(1, cost)
+            if not waits:
+                free += 1
+            limiter.now += 0.5
+        out[name] = {
+            "cost_tokens": round(cost),
+            "free": free,
+            "waits_s": waits,
+            "per_minute": round(60.0 * cfg.max_cost_tokens / cost / cfg.cost_per_seconds, 1),
+        }
+    # самое короткое сообщение не должно упираться в бюджет раньше, чем в счётчик сообщений
+    share = cfg.max_cost_tokens * cfg.per_seconds / (cfg.max_messages * cfg.cost_per_seconds)
+    out["min_chat_cost_tokens"] = round(estimate_cost("", "chat"))
+    out["flat_share_tokens"] = round(share)
+    return out
+
+
+# =========================
+# Масштаб
+# =========================
+def _fill(limiter, users: int) -> float:
+    """MESSAGES_PER_USER сообщений от каждого пользователя; возвращает мкс на check()."""
+    start = time.perf_counter()
+    for i in range(MESSAGES_PER_USER):
+        limiter.now = 1000.0 + i
+        for uid in range(users):
+            limiter.check(uid, SHORT_CHAT if uid % 4 == 0 else 0.0)
+    return (time.perf_counter() - start) * 1e6 / (users * MESSAGES_PER_USER)
+
+
+def scale(cfg: RateLimitConfig, users: int) -> Dict[str, Dict[str, object]]:
+    out: Dict[str, Dict[str, object]] = {}
+    for label, cls in (("legacy", LegacyRateLimiter), ("ring", _ClockedLimiter)):
+        gc.collect()
+        tracemalloc.start()
+        limiter = cls(cfg)
+        us_per_check = _fill(limiter, users)
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # повторный прогон без tracemalloc — он искажает время
+        limiter = cls(cfg)
+        us_per_check = _fill(limiter, users)
+
+        row: Dict[str, object] = {
+            "users": users,
+            "memory_mb": round(mem / 2 ** 20, 1),
+            "bytes_per_user": round(mem / users, 1),
+            "check_us": round(us_per_check, 3),
+        }
+        if isinstance(limiter, InMemoryRateLimiter):
+            # через минуту тишины все записи простаивают
+            limiter.now += 60
+            start = time.perf_counter()
+            evicted = limiter.sweep()
+            row["sweep_s"] = round(time.perf_counter() - start, 3)
+            row["evicted"] = evicted
+            row["left_after_sweep"] = len(limiter)
+        else:
+            row["left_after_sweep"] = "не чистится"
+        out[label] = row
+        del limiter
+    return out
+
+
+def run(users: int = DEFAULT_USERS) -> Dict[str, object]:
+    cfg = RateLimitConfig()
+    return {
+        "meta": {"python": platform.python_version(), "messages_per_user": MESSAGES_PER_USER},
+        "behavior": behavior(cfg),
+        "window_bound": window_bound(cfg),
+        "cost_waits": cost_waits(cfg),
+        "scale": scale(cfg, users),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк антифлуд-лимитера")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="сколько разных пользователей")
+    parser.add_argument("--out", help="записать JSON в файл (иначе — в stdout)")
+    args = parser.parse_args(argv)
+
+    text = json.dumps(run(args.users), ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
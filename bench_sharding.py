@@ -0,0 +1,181 @@
+# bench_sharding.py
+# Бенчмарк пропускной способности: один процесс против приёмника + N воркеров (sharding.py).
+# Сеть не участвует: апдейты синтетические, хендлер делает ту CPU-работу, что бот делает
+# на каждое сообщение, — распознавание автора, поиск по базе знаний, JSON пользователя.
+# Результат — апдейтов в секунду для каждого числа воркеров.
+#
+# Запуск:
+#   python bench_sharding.py
+#   python bench_sharding.py --updates 20000 --workers 1,2,4 --out bench_output.txt
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import Message
+
+import knowledge_base as kb
+from recognition import guess_authors_from_text
+from sharding import ShardRouter, consume, start_workers, stop_workers
+from user_queue import PerUserOrderingMiddleware
+
+DEFAULT_UPDATES = 5000
+DEFAULT_USERS = 500
+DEFAULT_WORKERS = (2, 4)
+
+_WORDS = (
+    "расскажи о поэме Федот стрелец как он писал про честность и иронию что думаешь о Пушкине "
+    "евгений онегин мцыри шинель отцы и дети обломов война и мир манера язык стиль герои тема "
+    "любовь смерть дорога судьба народ власть свобода юмор сатира"
+).split()
+
+# фиктивный токен: бот ничего не отправляет, нужен только Dispatcher'у
+_TOKEN = "123456:bench"
+
+
+def _synthetic_updates(n: int, users: int, seed: int = 7) -> List[Dict[str, Any]]:
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        uid = 1000 + rnd.randrange(users)
+        text = " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(4, 14)))
+        out.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": 1700000000,
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": uid, "is_bot": False, "first_name": "u"},
+                "text": text,
+            },
+        })
+    return out
+
+
+def _user_blob(uid: int) -> str:
+    """JSON пользователя примерно как user_{id}.json: история из 10 сообщений, summary."""
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": "текст " * 60, "author": "filatov"}
+               for i in range(10)]
+    return json.dumps({"user_id": uid, "selected_author": "filatov", "conversation_history": history,
+                       "summaries": {"filatov": {"text": "кратко " * 80}}}, ensure_ascii=False)
+
+
+def _build_dispatcher() -> Dispatcher:
+    router = Router()
+    blobs: Dict[int, str] = {}
+
+    @router.message(F.text)
+    async def handle(message: Message):
+        uid = message.from_user.id
+        text = message.text
+        guess_authors_from_text(text)
+        kb.rag_context("filatov", text)
+        data = json.loads(blobs.get(uid) or _user_blob(uid))
+        data["conversation_history"].append({"role": "user", "content": text})
+        del data["conversation_history"][:-10]
+        blobs[uid] = json.dumps(data, ensure_ascii=False)
+
+    dp = Dispatcher()
+    ordering = PerUserOrderingMiddleware(max_pending=10 ** 6, max_wait=0)
+    dp.message.middleware(ordering)
+    dp.include_router(router)
+    return dp
+
+
+def _warm_up() -> None:
+    guess_authors_from_text("прогрев")
+    kb.rag_context("filatov", "прогрев")
+
+
+# =========================
+# Один процесс
+# =========================
+async def _run_single(updates: List[Dict[str, Any]]) -> float:
+    dp = _build_dispatcher()
+    bot = Bot(token=_TOKEN)
+    _warm_up()
+    start = time.perf_counter()
+    await asyncio.gather(*(dp.feed_raw_update(bot, u) for u in updates))
+    elapsed = time.perf_counter() - start
+    await bot.session.close()
+    return elapsed
+
+
+# =========================
+# Приёмник + воркеры
+# =========================
+def _bench_worker(index: int, workers: int, updates) -> None:
+    asyncio.run(_bench_shard(updates))
+
+
+async def _bench_shard(updates) -> None:
+    dp = _build_dispatcher()
+    bot = Bot(token=_TOKEN)
+    _warm_up()
+    await consume(updates, lambda update: dp.feed_raw_update(bot, update))
+    await bot.session.close()
+
+
+def _run_sharded(updates: List[Dict[str, Any]], workers: int) -> float:
+    queues, procs = start_workers(_bench_worker, workers, queue_size=len(updates) + 1)
+    # старт воркеров (импорт, каталог, база знаний) в замер не входит: ждём, пока каждый
+    # заберёт из очереди пробный апдейт
+    for q in queues:
+        q.put(_synthetic_updates(1, 1, seed=0)[0])
+    while any(q.qsize() for q in queues):
+        time.sleep(0.05)
+    time.sleep(0.5)
+    router = ShardRouter(queues)
+    start = time.perf_counter()
+    for u in updates:
+        router.route(u)
+    stop_workers(queues, procs, timeout=600.0)
+    return time.perf_counter() - start
+
+
+def run(n: int = DEFAULT_UPDATES, users: int = DEFAULT_USERS, workers=DEFAULT_WORKERS) -> Dict[str, object]:
+    updates = _synthetic_updates(n, users)
+    results: Dict[str, Dict[str, float]] = {}
+
+    elapsed = asyncio.run(_run_single(updates))
+    results["single"] = {"seconds": round(elapsed, 3), "updates_per_s": round(n / elapsed, 1)}
+
+    for w in workers:
+        elapsed = _run_sharded(updates, w)
+        results[f"sharded_{w}"] = {"seconds": round(elapsed, 3), "updates_per_s": round(n / elapsed, 1)}
+
+    return {
+        "meta": {"python": platform.python_version(), "cpus": os.cpu_count(), "updates": n, "users": users},
+        "results": results,
+    }
+
+
+def _int_tuple(raw: str):
+    return tuple(int(x) for x in raw.split(",") if x.strip())
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк: один процесс против воркеров по user_id")
+    parser.add_argument("--updates", type=int, default=DEFAULT_UPDATES)
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--workers", default=",".join(map(str, DEFAULT_WORKERS)), help="числа воркеров через запятую")
+    parser.add_argument("--out", help="записать JSON в файл (иначе — в stdout)")
+    args = parser.parse_args(argv)
+
+    text = json.dumps(run(args.updates, args.users, _int_tuple(args.workers)), ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+# broadcast.py
+# Фоновая рассылка всем пользователям: быстро, но в пределах лимитов Telegram, и с продолжением после падения.
+#
+# - темп — token bucket на rate сообщений в секунду (у Telegram ~30/с на бота для разных чатов),
+#   одновременно в полёте не больше concurrency запросов;
+# - TelegramRetryAfter ставит на паузу всю рассылку (лимит у Telegram общий на бота) и повторяет
+#   то же сообщение; сетевые ошибки и 5xx — несколько повторов с паузой;
+# - прогресс пишется в data/broadcasts/<job_id>.json, незавершённые рассылки продолжаются при старте;
+# - админ видит живой прогресс (одно сообщение, которое обновляется) и итог:
+#   доставлено / заблокировали бота / ошибки — с причинами;
+# - недоступных пользователей (заблокировали бота, удалили аккаунт) пачками отдаём
+#   в on_unreachable, чтобы следующие рассылки их пропускали.
+from __future__ import annotations
+
+import asyncio
+import html
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+logger = logging.getLogger(__name__)
+
+# результат доставки одному пользователю
+DELIVERED = "delivered"
+BLOCKED = "blocked"     # бот заблокирован / аккаунт удалён — писать бесполезно
+FAILED = "failed"       # прочие ошибки (после повторов)
+OUTCOMES = (DELIVERED, BLOCKED, FAILED)
+
+
+@dataclass
+class BroadcastConfig:
+    rate: float = 25.0                # сообщений в секунду (с запасом от ~30/с у Telegram)
+    burst: int = 5                    # сколько можно отправить разом после простоя
+    concurrency: int = 8              # запросов в полёте одновременно
+    max_retries: int = 3              # повторов на сетевые ошибки / 5xx
+    max_retry_after: int = 5          # сколько раз подряд терпеть RetryAfter на одном сообщении
+    checkpoint_seconds: float = 2.0   # как часто сохранять прогресс
+    progress_seconds: float = 5.0     # как часто обновлять сообщение с прогрессом
+
+    @classmethod
+    def from_env(cls) -> "BroadcastConfig":
+        return cls(
+            rate=float(os.getenv("BROADCAST_RATE", cls.rate)),
+            concurrency=int(os.getenv("BROADCAST_CONCURRENCY", cls.concurrency)),
+        )
+
+
+class TokenBucket:
+    """Token bucket для asyncio: take() ждёт токен; pause() останавливает выдачу на время."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1, int(capacity))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def take(self) -> None:
+        # один ожидающий за раз — токены раздаются по очереди, а не пачкой после паузы
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+def _write_json(path: str, obj: Any) -> None:
+    # у каждой записи свой временный файл: две одновременные записи не портят друг другу файл,
+    # os.replace оставляет целиком одну из них
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path) or ".",
+                                     prefix=os.path.basename(path) + ".", suffix=".tmp", delete=False) as f:
+        tmp = f.name
+        try:
+            json.dump(obj, f, ensure_ascii=False)
+        except BaseException:
+            f.close()
+            os.unlink(tmp)
+            raise
+    os.replace(tmp, path)
+
+
+def _broadcasts_dir() -> str:
+    path = os.path.join(os.getcwd(), "data", "broadcasts")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class BroadcastJob:
+    """
+    Состояние одной рассылки (то, что лежит в чекпоинте).
+
+    Отправка идёт параллельно, поэтому сообщения завершаются не по порядку:
+    watermark — все пользователи до этого индекса обработаны, done_ahead — обработанные за ним.
+    После падения продолжаем с watermark, пропуская done_ahead из последнего чекпоинта.
+    Что успело уйти после него (до checkpoint_seconds отправки), уйдёт повторно:
+    доставка "хотя бы один раз", а не "ровно один".
+    """
+
+    def __init__(self, job_id: str, text: str, users: List[int], admin_chat_id: Optional[int] = None):
+        self.job_id = job_id
+        self.text = text
+        self.users = users
+        self.admin_chat_id = admin_chat_id
+        self.progress_message_id: Optional[int] = None
+        self.status = "running"  # running | done | cancelled
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.watermark = 0
+        self.done_ahead: Set[int] = set()
+        self.counts: Dict[str, int] = {k: 0 for k in OUTCOMES}
+        self.reasons: Dict[str, int] = {}  # причина недоставки -> сколько раз
+
+    @property
+    def path(self) -> str:
+        return os.path.join(_broadcasts_dir(), f"{self.job_id}.json")
+
+    @property
+    def users_path(self) -> str:
+        # список получателей пишется один раз, чекпоинт прогресса — маленький
+        return os.path.join(_broadcasts_dir(), f"{self.job_id}.users.json")
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counts.values())
+
+    def mark_done(self, index: int, outcome: str, reason: Optional[str] = None) -> None:
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
+        if reason:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        self.done_ahead.add(index)
+        while self.watermark in self.done_ahead:
+            self.done_ahead.discard(self.watermark)
+            self.watermark += 1
+
+    def pending_indices(self) -> Iterable[int]:
+        for i in range(self.watermark, len(self.users)):
+            if i not in self.done_ahead:
+                yield i
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "text": self.text,
+            "admin_chat_id": self.admin_chat_id,
+            "progress_message_id": self.progress_message_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "watermark": self.watermark,
+            "done_ahead": sorted(self.done_ahead),
+            "counts": self.counts,
+            "reasons": self.reasons,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any], users: List[int]) -> "BroadcastJob":
+        job = cls(d["job_id"], d["text"], users, d.get("admin_chat_id"))
+        job.progress_message_id = d.get("progress_message_id")
+        job.status = d.get("status", "running")
+        job.created_at = float(d.get("created_at") or time.time())
+        job.finished_at = d.get("finished_at")
+        job.watermark = int(d.get("watermark", 0))
+        job.done_ahead = {int(x) for x in d.get("done_ahead", [])}
+        job.counts.update({k: int(v) for k, v in (d.get("counts") or {}).items()})
+        job.reasons = {k: int(v) for k, v in (d.get("reasons") or {}).items()}
+        return job
+
+    @classmethod
+    def load(cls, path: str) -> "BroadcastJob":
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        with open(os.path.join(os.path.dirname(path), f"{d['job_id']}.users.json"), "r", encoding="utf-8") as f:
+            users = [int(x) for x in json.load(f)]
+        return cls.from_dict(d, users)
+
+    def save_users(self) -> None:
+        _write_json(self.users_path, self.users)
+
+    def save(self) -> None:
+        _write_json(self.path, self.to_dict())
+
+    def format_progress(self) -> str:
+        total = len(self.users)
+        pct = int(100 * self.processed / total) if total else 100
+        head = {
+            "running": "📣 <b>Рассылка идёт</b>",
+            "done": "✅ <b>Рассылка завершена</b>",
+            "cancelled": "⛔ <b>Рассылка остановлена</b>",
+        }.get(self.status, "📣 <b>Рассылка</b>")
+        lines = [
+            f"{head} <code>{self.job_id}</code>\n",
+            f"Обработано: <b>{self.processed}</b> из <b>{total}</b> ({pct}%)",
+            f"Доставлено: <b>{self.counts[DELIVERED]}</b>",
+            f"Заблокировали бота: <b>{self.counts[BLOCKED]}</b>",
+            f"Ошибки: <b>{self.counts[FAILED]}</b>",
+        ]
+        if self.reasons:
+            top = sorted(self.reasons.items(), key=lambda x: x[1], reverse=True)[:5]
+            lines.append("Причины: " + ", ".join(f"{html.escape(r)} — {n}" for r, n in top))
+        end = self.finished_at or time.time()
+        lines.append(f"Время: <b>{int(end - self.created_at)} сек</b>")
+        return "\n".join(lines)
+
+
+# признаки того, что пользователю писать больше бесполезно -> причина
+_UNREACHABLE_MARKERS = (
+    ("bot was blocked by the user", "blocked"),
+    ("user is deactivated", "deactivated"),
+    ("chat not found", "chat_not_found"),
+    ("bot was kicked", "kicked"),
+)
+
+
+def failure_reason(e: Exception) -> Tuple[str, str]:
+    """Ошибка отправки -> (blocked | failed, короткая причина)."""
+    msg = getattr(e, "message", None) or str(e)
+    low = msg.lower()
+    for marker, reason in _UNREACHABLE_MARKERS:
+        if marker in low:
+            return BLOCKED, reason
+    if isinstance(e, TelegramForbiddenError):
+        return BLOCKED, "forbidden"
+    if isinstance(e, TelegramBadRequest):
+        return FAILED, "bad_request: " + msg.split(":", 1)[-1].strip()[:60]
+    return FAILED, type(e).__name__
+
+
+class BroadcastManager:
+    """Запуск, продолжение после рестарта и остановка фоновых рассылок."""
+
+    def __init__(
+        self,
+        cfg: Optional[BroadcastConfig] = None,
+        on_unreachable: Optional[Callable[[List[Tuple[int, str]]], None]] = None,
+    ):
+        self.cfg = cfg or BroadcastConfig()
+        # [(user_id, причина), ...] — пачками при каждом чекпоинте; вызывается в event loop,
+        # как и остальной код, что пишет users.json / stats.json, — без гонок за файлы
+        self.on_unreachable = on_unreachable
+        self.bucket = TokenBucket(self.cfg.rate, self.cfg.burst)
+        self.jobs: Dict[str, BroadcastJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    # ---------- управление ----------
+
+    async def start(self, bot, text: str, users: Iterable[int], admin_chat_id: Optional[int] = None) -> BroadcastJob:
+        job = BroadcastJob(uuid.uuid4().hex[:8], text, list(dict.fromkeys(int(u) for u in users)), admin_chat_id)
+        if admin_chat_id is not None:
+            try:
+                msg = await bot.send_message(admin_chat_id, job.format_progress(), parse_mode=ParseMode.HTML)
+                job.progress_message_id = msg.message_id
+            except Exception as e:
+                logger.warning("broadcast %s: не удалось отправить прогресс: %s", job.job_id, e)
+        job.save_users()
+        job.save()
+        self._spawn(bot, job)
+        return job
+
+    def resume_all(self, bot) -> List[BroadcastJob]:
+        """Продолжить незавершённые рассылки из чекпоинтов (вызывать при старте бота)."""
+        resumed = []
+        for name in sorted(os.listdir(_broadcasts_dir())):
+            if not name.endswith(".json") or name.endswith(".users.json"):
+                continue
+            try:
+                job = BroadcastJob.load(os.path.join(_broadcasts_dir(), name))
+            except Exception as e:
+                logger.warning("broadcast: битый чекпоинт %s: %s", name, e)
+                continue
+            if job.status != "running" or job.job_id in self._tasks:
+                continue
+            logger.info("broadcast %s: продолжаю с %s/%s", job.job_id, job.processed, len(job.users))
+            self._spawn(bot, job)
+            resumed.append(job)
+        return resumed
+
+    def cancel(self, job_id: str) -> bool:
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        self.jobs[job_id].status = "cancelled"
+        task.cancel()
+        return True
+
+    def running(self) -> List[BroadcastJob]:
+        return [self.jobs[jid] for jid in self._tasks if jid in self.jobs]
+
+    def _spawn(self, bot, job: BroadcastJob) -> None:
+        self.jobs[job.job_id] = job
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job.job_id] = task
+        task.add_done_callback(lambda _t, jid=job.job_id: self._tasks.pop(jid, None))
+
+    # ---------- отправка ----------
+
+    async def _send_one(self, bot, chat_id: int, text: str) -> Tuple[str, Optional[str]]:
+        """-> (исход, причина недоставки | None)"""
+        retries = 0
+        retry_afters = 0
+        while True:
+            await self.bucket.take()
+            try:
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
+                return DELIVERED, None
+            except TelegramRetryAfter as e:
+                # лимит у Telegram на бота целиком — тормозим всю рассылку, а не одно сообщение
+                self.bucket.pause(e.retry_after)
+                retry_afters += 1
+                if retry_afters > self.cfg.max_retry_after:
+                    return FAILED, "retry_after"
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                return failure_reason(e)
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                retries += 1
+                if retries > self.cfg.max_retries:
+                    return failure_reason(e)
+                await asyncio.sleep(min(30.0, 2.0 ** retries))
+            except Exception as e:
+                logger.warning("broadcast: %s: %s", chat_id, e)
+                return failure_reason(e)
+
+    async def _report(self, bot, job: BroadcastJob) -> None:
+        if job.admin_chat_id is None:
+            return
+        try:
+            if job.progress_message_id is not None:
+                await bot.edit_message_text(
+                    job.format_progress(),
+                    chat_id=job.admin_chat_id,
+                    message_id=job.progress_message_id,
+                    parse_mode=ParseMode.HTML,
+                )
+            elif job.status != "running":
+                await bot.send_message(job.admin_chat_id, job.format_progress(), parse_mode=ParseMode.HTML)
+        except TelegramBadRequest:
+            pass  # "message is not modified" и т.п.
+        except Exception as e:
+            logger.warning("broadcast %s: не удалось обновить прогресс: %s", job.job_id, e)
+
+    async def _run(self, bot, job: BroadcastJob) -> None:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.cfg.concurrency * 2)
+        unreachable: List[Tuple[int, str]] = []
+
+        def flush_unreachable():
+            if not unreachable or self.on_unreachable is None:
+                unreachable.clear()
+                return
+            batch = unreachable[:]
+            unreachable.clear()
+            try:
+                self.on_unreachable(batch)
+            except Exception as e:
+                logger.warning("broadcast %s: не удалось убрать недоступных: %s", job.job_id, e)
+
+        async def worker():
+            while True:
+                index = await queue.get()
+                try:
+                    outcome, reason = await self._send_one(bot, job.users[index], job.text)
+                    job.mark_done(index, outcome, reason)
+                    if outcome == BLOCKED:
+                        unreachable.append((job.users[index], reason))
+                finally:
+                    queue.task_done()
+
+        async def reporter():
+            last_save = last_report = time.monotonic()
+            while True:
+                await asyncio.sleep(min(self.cfg.checkpoint_seconds, self.cfg.progress_seconds))
+                now = time.monotonic()
+                if now - last_save >= self.cfg.checkpoint_seconds:
+                    # снимок берём в event loop: воркеры меняют состояние параллельно
+                    await asyncio.to_thread(_write_json, job.path, job.to_dict())
+                    flush_unreachable()
+                    last_save = now
+                if now - last_report >= self.cfg.progress_seconds:
+                    await self._report(bot, job)
+                    last_report = now
+
+        workers = [asyncio.create_task(worker()) for _ in range(max(1, self.cfg.concurrency))]
+        progress = asyncio.create_task(reporter())
+        try:
+            for index in job.pending_indices():
+                await queue.put(index)
+            await queue.join()
+            job.status = "done"
+        finally:
+            for t in workers:
+                t.cancel()
+            progress.cancel()
+            # остановка процесса (не cancel()) оставляет статус running —
+            # рассылка продолжится при следующем старте с сохранённого места
+            if job.status != "running":
+                job.finished_at = time.time()
+            job.save()
+            flush_unreachable()
+            logger.info("broadcast %s: %s, %s", job.job_id, job.status, job.counts)
+            if job.status != "running":
+                await self._report(bot, job)
+
+    def shutdown(self) -> None:
+        """Остановка процесса: прервать рассылки, оставив их продолжаемыми."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+
+broadcasts = BroadcastManager(BroadcastConfig.from_env())
@@ -0,0 +1,282 @@
+# catalog.py
+# Литературный каталог для распознавания автора: произведения и герои из файла данных.
+#
+# Источник — TSV (catalog/works.tsv), одна фраза на строку:
+#   kind <TAB> author_key <TAB> фраза [<TAB> флаги]
+#   kind:  work | hero
+#   флаги: exact — только точной фразой, без нечёткого поиска (как SHORT_TITLES_RISK)
+# Пустые строки и строки с # пропускаются.
+#
+# В памяти каталог — префиксное дерево (trie) на плоских массивах (array), а не словарь
+# на каждый узел: на десятках тысяч фраз это мегабайты вместо сотен мегабайт.
+# Собранное дерево кэшируется рядом с источником (.idx) и при следующем старте
+# читается с диска одним куском, без перестройки.
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+CATALOG_PATH = os.getenv(
+    "RECOGNITION_CATALOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog", "works.tsv"),
+)
+
+# Меняется при любой правке формата .idx или логики сборки — старый кэш тогда пересобирается
+CATALOG_FORMAT = 1
+
+_MAGIC = b"RCAT"
+
+# (kind, author_key, фраза, exact)
+CatalogRow = Tuple[str, str, str, bool]
+
+
+def read_catalog(path: Optional[str] = None) -> Iterator[CatalogRow]:
+    """Строки каталога как есть (без нормализации). Нет файла — нет строк."""
+    path = path or CATALOG_PATH
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            parts = line.split("\t")
+            if len(parts) < 3:
+                logging.warning("catalog %s:%s: ожидалось kind<TAB>author<TAB>фраза", path, lineno)
+                continue
+            flags = {x.strip() for x in parts[3].split(",")} if len(parts) > 3 else set()
+            yield parts[0].strip(), parts[1].strip(), parts[2].strip(), "exact" in flags
+
+
+def source_stamp(path: Optional[str] = None, *extra) -> str:
+    """Отпечаток источника: размер/mtime файла + всё, что влияет на сборку (правила в коде)."""
+    path = path or CATALOG_PATH
+    try:
+        st = os.stat(path)
+        file_part = [st.st_size, st.st_mtime_ns]
+    except OSError:
+        file_part = None
+    raw = json.dumps([CATALOG_FORMAT, file_part, extra], ensure_ascii=False, sort_keys=True, default=sorted)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class PhraseTrie:
+    """
+    Префиксное дерево в плоских массивах.
+
+    Узлы: дети узла n — рёбра edge_start[n]..edge_start[n+1], отсортированы по коду
+    символа (поиск — bisect). Фразы, кончающиеся в узле n, — out_ids[out_start[n]..out_start[n+1]].
+    Фразы: длина, kind, автор, exact и сам текст (одна строка + смещения).
+
+    Совпадение засчитывается только с начала слова, поэтому суффиксные ссылки
+    Ахо–Корасик не нужны: от начала каждого слова спускаемся по дереву, пока символы
+    совпадают (обычно это 1–3 шага). exact-фразы должны ещё и кончаться на границе слова.
+    """
+
+    _ARRAYS = (
+        ("edge_start", "I"), ("edge_label", "I"), ("edge_target", "I"),
+        ("out_start", "I"), ("out_ids", "I"),
+        ("ph_len", "H"), ("ph_kind", "B"), ("ph_author", "H"), ("ph_exact", "B"),
+        ("ph_offset", "I"),
+    )
+
+    def __init__(self):
+        for name, code in self._ARRAYS:
+            setattr(self, name, array(code))
+        self.kinds: List[str] = []
+        self.authors: List[str] = []
+        self.text = ""
+
+    def __len__(self) -> int:
+        return len(self.ph_len)
+
+    # --- фразы ---
+    def phrase(self, pid: int) -> str:
+        return self.text[self.ph_offset[pid]:self.ph_offset[pid] + self.ph_len[pid]]
+
+    def kind(self, pid: int) -> str:
+        return self.kinds[self.ph_kind[pid]]
+
+    def author(self, pid: int) -> str:
+        return self.authors[self.ph_author[pid]]
+
+    def is_exact(self, pid: int) -> bool:
+        return bool(self.ph_exact[pid])
+
+    # --- сборка ---
+    @classmethod
+    def build(cls, rows: Iterable[CatalogRow]) -> "PhraseTrie":
+        """rows — уже нормализованные фразы. Повторы (фраза, kind, автор) схлопываются."""
+        t = cls()
+        kind_ids: Dict[str, int] = {}
+        author_ids: Dict[str, int] = {}
+        seen: Dict[Tuple[str, int, int], int] = {}
+        texts: List[str] = []
+        offset = 0
+
+        goto: List[Dict[int, int]] = [{}]
+        own_out: List[List[int]] = [[]]
+
+        for kind, akey, phrase, exact in rows:
+            if not phrase:
+                continue
+            k = kind_ids.setdefault(kind, len(kind_ids))
+            a = author_ids.setdefault(akey, len(author_ids))
+            prev = seen.get((phrase, k, a))
+            if prev is not None:
+                # одна и та же фраза дважды: exact побеждает (политика строже)
+                if exact:
+                    t.ph_exact[prev] = 1
+                continue
+
+            pid = len(t.ph_len)
+            seen[(phrase, k, a)] = pid
+            t.ph_len.append(len(phrase))
+            t.ph_kind.append(k)
+            t.ph_author.append(a)
+            t.ph_exact.append(1 if exact else 0)
+            t.ph_offset.append(offset)
+            texts.append(phrase)
+            offset += len(phrase)
+
+            node = 0
+            for ch in phrase:
+                c = ord(ch)
+                nxt = goto[node].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][c] = nxt
+                    goto.append({})
+                    own_out.append([])
+                node = nxt
+            own_out[node].append(pid)
+
+        for node in range(len(goto)):
+            t.edge_start.append(len(t.edge_label))
+            for c in sorted(goto[node]):
+                t.edge_label.append(c)
+                t.edge_target.append(goto[node][c])
+            t.out_start.append(len(t.out_ids))
+            t.out_ids.extend(own_out[node])
+        t.edge_start.append(len(t.edge_label))
+        t.out_start.append(len(t.out_ids))
+
+        t.kinds = sorted(kind_ids, key=kind_ids.get)
+        t.authors = sorted(author_ids, key=author_ids.get)
+        t.text = "".join(texts)
+        return t
+
+    # --- поиск ---
+    def iter_matches(self, text: str) -> Iterator[int]:
+        """phrase_id всех фраз, найденных в (нормализованном) тексте."""
+        es, labels, targets = self.edge_start, self.edge_label, self.edge_target
+        out_start, out_ids, ph_exact = self.out_start, self.out_ids, self.ph_exact
+        n = len(text)
+        start = 0
+        while start < n:
+            node = 0
+            i = start
+            while i < n:
+                lo, hi = es[node], es[node + 1]
+                c = ord(text[i])
+                j = bisect_left(labels, c, lo, hi)
+                if j == hi or labels[j] != c:
+                    break
+                node = targets[j]
+                i += 1
+                for k in range(out_start[node], out_start[node + 1]):
+                    pid = out_ids[k]
+                    if ph_exact[pid] and i < n and text[i] != " ":
+                        continue
+                    yield pid
+
+            nxt = text.find(" ", start)
+            if nxt < 0:
+                break
+            start = nxt + 1
+
+    # --- кэш на диске ---
+    def save(self, path: str, stamp: str) -> None:
+        header = {
+            "stamp": stamp,
+            "byteorder": sys.byteorder,
+            "kinds": self.kinds,
+            "authors": self.authors,
+            "arrays": [[name, code, getattr(self, name).itemsize, len(getattr(self, name))] for name, code in self._ARRAYS],
+        }
+        head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_MAGIC)
+            f.write(struct.pack("<I", len(head)))
+            f.write(head)
+            for name, _code in self._ARRAYS:
+                getattr(self, name).tofile(f)
+            f.write(self.text.encode("utf-8"))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, stamp: str) -> Optional["PhraseTrie"]:
+        """Автомат из кэша или None, если кэша нет, он от другого источника или битый."""
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+        except OSError:
+            return None
+
+        try:
+            if blob[:4] != _MAGIC:
+                return None
+            (head_len,) = struct.unpack_from("<I", blob, 4)
+            pos = 8 + head_len
+            header = json.loads(blob[8:pos].decode("utf-8"))
+            if header.get("stamp") != stamp or header.get("byteorder") != sys.byteorder:
+                return None
+
+            t = cls()
+            if [spec[0] for spec in header["arrays"]] != [name for name, _code in cls._ARRAYS]:
+                return None
+            specs = {name: (code, itemsize, length) for name, code, itemsize, length in header["arrays"]}
+            for name, code in cls._ARRAYS:
+                s_code, itemsize, length = specs[name]
+                arr = array(code)
+                if s_code != code or arr.itemsize != itemsize:
+                    return None
+                end = pos + itemsize * length
+                arr.frombytes(blob[pos:end])
+                setattr(t, name, arr)
+                pos = end
+            t.kinds = header["kinds"]
+            t.authors = header["authors"]
+            t.text = blob[pos:].decode("utf-8")
+        except (ValueError, KeyError, TypeError, struct.error, UnicodeDecodeError):
+            return None
+
+        if len(t.edge_start) != len(t.out_start) or len(t.ph_offset) != len(t.ph_len):
+            return None
+        return t
+
+
+def load_trie(rows_factory, stamp: str, cache_path: Optional[str] = None) -> PhraseTrie:
+    """
+    Автомат из кэша, если отпечаток совпал; иначе собрать из rows_factory() и сохранить.
+    Не удалось записать кэш (read-only диск и т.п.) — работаем с собранным в памяти.
+    """
+    cache_path = cache_path or os.path.splitext(CATALOG_PATH)[0] + ".idx"
+    trie = PhraseTrie.load(cache_path, stamp)
+    if trie is not None:
+        return trie
+
+    trie = PhraseTrie.build(rows_factory())
+    try:
+        trie.save(cache_path, stamp)
+    except OSError as e:
+        logging.warning("catalog: не удалось сохранить кэш %s: %s", cache_path, e)
+    return trie
@@ -7,3 +7,27 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 
 # GigaChat
 GIGACHAT_CREDENTIALS = os.getenv("GIGACHAT_CREDENTIALS", "").strip()
+GIGACHAT_MODEL = os.getenv("GIGACHAT_MODEL", "GigaChat:latest").strip()
+
+# Rolling summary диалога (1 — включено, 0 — шлём последние сообщения как раньше)
+ROLLING_SUMMARY = os.getenv("ROLLING_SUMMARY", "1").strip() not in ("0", "false", "no", "")
+
+# Антифлуд: memory — в процессе (один инстанс), sqlite / redis — общий лимит для нескольких инстансов
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower()
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", os.path.join("data", "rate_limit.sqlite3")).strip()
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0").strip()
+
+# Доставка апдейтов: пусто — long polling; иначе вебхук на публичный адрес этого сервиса
+# (например https://my-bot.onrender.com), путь WEBHOOK_PATH на том же веб-сервере, что /health
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "/telegram/webhook").strip().lstrip("/")
+# Секрет в заголовке X-Telegram-Bot-Api-Secret-Token; пусто — выводится из BOT_TOKEN (стабилен между рестартами)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+# Сколько одновременных соединений Telegram открывает к вебхуку (1–100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Выбрасывать ли накопившиеся апдейты при старте (раньше — всегда)
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0").strip().lower() in ("1", "true", "yes")
+
+# Процессов-обработчиков: 1 — всё в одном процессе; N > 1 — один приёмник апдейтов
+# раздаёт их N воркерам по user_id (см. sharding.py)
+BOT_WORKERS = max(1, int(os.getenv("BOT_WORKERS", "1")))
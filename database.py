@@ -1,13 +1,52 @@
 import json
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional, Tuple
+
+from config import ROLLING_SUMMARY
+
+# Сколько сообщений храним в истории "как есть"
+HISTORY_MAX_MESSAGES = 10
+
+# Сколько последних сообщений уходит в промпт дословно (последний обмен репликами)
+RECENT_WINDOW_MESSAGES = 2
+
+# Сколько вытесненных сообщений максимум ждут сворачивания в summary
+SUMMARY_PENDING_MAX = 40
+
+# Сколько живёт вопрос, заданный до выбора автора (ждёт нажатия "Ответить как …")
+PENDING_QUESTION_TTL_SECONDS = 3600
+
+# Для скольких пользователей держать в памяти режим / автора / отложенный вопрос
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "50000"))
+
+# (mode, selected_author, текст отложенного вопроса)
+RoutingState = Tuple[Optional[str], Optional[str], str]
 
 
 class Database:
     def __init__(self, data_dir: str = "data"):
         self.data_dir = data_dir
         os.makedirs(self.data_dir, exist_ok=True)
+        # то, что антифлуд смотрит до хендлера, — без чтения user_{id}.json на каждый апдейт;
+        # обновляется при каждом чтении и записи файла
+        self._routing: "OrderedDict[int, RoutingState]" = OrderedDict()
+        self._routing_lock = threading.Lock()
+
+    def _remember_routing(self, user_id: int, data: dict) -> None:
+        state = (data.get("mode"), data.get("selected_author"), (data.get("pending_question") or {}).get("text") or "")
+        with self._routing_lock:
+            self._routing[user_id] = state
+            self._routing.move_to_end(user_id)
+            while len(self._routing) > ROUTING_CACHE_SIZE:
+                self._routing.popitem(last=False)
+
+    def routing_state(self, user_id: int) -> Optional[RoutingState]:
+        """(mode, selected_author, отложенный вопрос) из памяти; None — пользователя ещё не читали."""
+        with self._routing_lock:
+            return self._routing.get(user_id)
 
     def _get_user_file(self, user_id: int) -> str:
         return os.path.join(self.data_dir, f"user_{user_id}.json")
@@ -34,24 +73,49 @@ class Database:
         data.setdefault("mode", None)  # None | compare_first | compare_second
         data.setdefault("compare_first_author", None)
 
+        # rolling summary: author_key -> {"text": ..., "updated_at": ...}
+        data.setdefault("summaries", {})
+        # сообщения, вышедшие из свежего окна промпта, но ещё не свёрнутые в summary
+        data.setdefault("summary_pending", {})
+
+        # вопрос, заданный до выбора автора: {"text": ..., "asked_at": ...}
+        data.setdefault("pending_question", None)
+
+        self._remember_routing(user_id, data)
         return data
 
     def save_user_data(self, user_id: int, data: dict) -> None:
         file_path = self._get_user_file(user_id)
         with open(file_path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        self._remember_routing(user_id, data)
 
     def update_conversation(self, user_id: int, author_key: str, user_message: str, bot_response: str) -> None:
         data = self.get_user_data(user_id)
 
         data.setdefault("conversation_history", [])
-        data["conversation_history"].append({
+        history = data["conversation_history"]
+
+        # прошлый обмен репликами выходит из "свежего окна" промпта —
+        # ставим его в очередь на сворачивание в summary (если summary вообще ведём)
+        if ROLLING_SUMMARY:
+            pending = data.setdefault("summary_pending", {})
+            for msg in history[-RECENT_WINDOW_MESSAGES:]:
+                akey = msg.get("author") or author_key
+                queue = pending.setdefault(akey, [])
+                queue.append({"role": msg.get("role"), "content": msg.get("content", "")})
+                if len(queue) > SUMMARY_PENDING_MAX:
+                    del queue[:-SUMMARY_PENDING_MAX]
+
+        history.append({
             "role": "user",
+            "author": author_key,
             "content": user_message,
             "timestamp": datetime.now().isoformat()
         })
-        data["conversation_history"].append({
+        history.append({
             "role": "assistant",
+            "author": author_key,
             "content": bot_response,
             "timestamp": datetime.now().isoformat()
         })
@@ -59,9 +123,38 @@ class Database:
         data["selected_author"] = author_key
 
         # ограничиваем историю (последние 10 сообщений)
-        if len(data["conversation_history"]) > 10:
-            data["conversation_history"] = data["conversation_history"][-10:]
+        if len(history) > HISTORY_MAX_MESSAGES:
+            data["conversation_history"] = history[-HISTORY_MAX_MESSAGES:]
+
+        self.save_user_data(user_id, data)
+
+    # ---------- rolling summary helpers ----------
+
+    def get_summary(self, user_id: int, author_key: str) -> str:
+        data = self.get_user_data(user_id)
+        item = (data.get("summaries") or {}).get(author_key) or {}
+        return item.get("text", "")
+
+    def get_pending_for_summary(self, user_id: int, author_key: str) -> List[dict]:
+        data = self.get_user_data(user_id)
+        return list((data.get("summary_pending") or {}).get(author_key) or [])
 
+    def save_summary(self, user_id: int, author_key: str, text: str, consumed: int) -> None:
+        """
+        Сохраняет новое summary и убирает из очереди первые `consumed` сообщений.
+        Данные перечитываются заново: пока шло сворачивание, могли прийти новые сообщения.
+        """
+        data = self.get_user_data(user_id)
+        data.setdefault("summaries", {})[author_key] = {
+            "text": text,
+            "updated_at": datetime.now().isoformat(),
+        }
+        pending = data.setdefault("summary_pending", {})
+        rest = (pending.get(author_key) or [])[max(0, int(consumed)):]
+        if rest:
+            pending[author_key] = rest
+        else:
+            pending.pop(author_key, None)
         self.save_user_data(user_id, data)
 
     # ---------- compare state helpers ----------
@@ -82,15 +175,44 @@ class Database:
         data["compare_first_author"] = None
         self.save_user_data(user_id, data)
 
+    # ---------- pending question helpers ----------
+
+    def set_pending_question(self, user_id: int, text: Optional[str]) -> None:
+        data = self.get_user_data(user_id)
+        data["pending_question"] = {"text": text, "asked_at": datetime.now().isoformat()} if text else None
+        self.save_user_data(user_id, data)
+
+    def pop_pending_question(self, user_id: int) -> Optional[str]:
+        """
+        Забирает отложенный вопрос (один раз). Просроченный вопрос не возвращается.
+        """
+        data = self.get_user_data(user_id)
+        item = data.get("pending_question") or {}
+        if not item:
+            return None
+        data["pending_question"] = None
+        self.save_user_data(user_id, data)
+
+        try:
+            age = (datetime.now() - datetime.fromisoformat(item.get("asked_at", ""))).total_seconds()
+        except (TypeError, ValueError):
+            return None
+        if age > PENDING_QUESTION_TTL_SECONDS:
+            return None
+        return item.get("text") or None
+
     # ---------- reset helpers ----------
 
     def reset_dialog(self, user_id: int, keep_author: bool = True) -> None:
         data = self.get_user_data(user_id)
         selected = data.get("selected_author") if keep_author else None
         data["conversation_history"] = []
+        data["summaries"] = {}
+        data["summary_pending"] = {}
         data["selected_author"] = selected
         data["mode"] = None
         data["compare_first_author"] = None
+        data["pending_question"] = None
         self.save_user_data(user_id, data)
 
     def clear_all(self, user_id: int) -> None:
@@ -99,9 +221,12 @@ class Database:
         """
         data = self.get_user_data(user_id)
         data["conversation_history"] = []
+        data["summaries"] = {}
+        data["summary_pending"] = {}
         data["selected_author"] = None
         data["mode"] = None
         data["compare_first_author"] = None
+        data["pending_question"] = None
         self.save_user_data(user_id, data)
 
 
@@ -1,11 +1,14 @@
 # inline_keyboards.py
+# Клавиатуры строятся один раз и переиспользуются: статичные — при импорте, клавиатуры
+# эпох и авторов — при первом запросе, до следующего изменения реестра авторов
+# (authors.registry_version()). Готовые объекты не изменять — они общие для всех ответов.
 from __future__ import annotations
 
-from typing import List
+from typing import Dict, List
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from authors import get_groups, get_authors_by_group
+from authors import get_groups, get_authors_by_group, registry_version
 
 
 # ===== Настройки "адаптива" =====
@@ -36,19 +39,55 @@ def _authors_per_row_by_length(author_names: List[str]) -> int:
     return 1 if longest >= AUTHOR_TEXT_LEN_FOR_SINGLE_ROW else AUTHORS_PER_ROW_DEFAULT
 
 
+# кэш клавиатур, зависящих от реестра авторов: "groups" / "authors:<эпоха>" -> клавиатура
+_registry_keyboards: Dict[str, InlineKeyboardMarkup] = {}
+_registry_keyboards_version = -1
+
+
+def _registry_keyboard(name: str, build) -> InlineKeyboardMarkup:
+    global _registry_keyboards_version
+    version = registry_version()
+    if _registry_keyboards_version != version:
+        _registry_keyboards.clear()
+        _registry_keyboards_version = version
+    kb = _registry_keyboards.get(name)
+    if kb is None:
+        kb = _registry_keyboards[name] = build()
+    return kb
+
+
+def prebuild_keyboards() -> int:
+    """Собрать клавиатуры эпох и авторов заранее (при старте). Возвращает сколько собрано."""
+    get_groups_keyboard()
+    for group in get_groups():
+        get_authors_keyboard(group)
+    return len(_registry_keyboards)
+
+
 # =========================
 # 📚 ВЫБОР ЭПОХИ
 # =========================
-def get_groups_keyboard() -> InlineKeyboardMarkup:
+def _build_groups_keyboard() -> InlineKeyboardMarkup:
     groups = get_groups()
     buttons = [InlineKeyboardButton(text=g, callback_data=f"group_{g}") for g in groups]
     return InlineKeyboardMarkup(inline_keyboard=_chunk(buttons, GROUPS_PER_ROW))
 
 
+def get_groups_keyboard() -> InlineKeyboardMarkup:
+    return _registry_keyboard("groups", _build_groups_keyboard)
+
+
 # =========================
 # 👤 ВЫБОР АВТОРА (полное ФИО + адаптация рядов)
 # =========================
 def get_authors_keyboard(group: str) -> InlineKeyboardMarkup:
+    if group not in get_groups():
+        # callback_data можно подделать — под неизвестные эпохи кэш не раздуваем
+        return _build_authors_keyboard(group)
+    return _registry_keyboard(f"authors:{group}", lambda: _build_authors_keyboard(group))
+
+
+def _build_authors_keyboard(group: str) -> InlineKeyboardMarkup:
     authors = get_authors_by_group(group)  # key -> full name (уже отсортировано)
     names = list(authors.values())
 
@@ -68,7 +107,7 @@ def get_authors_keyboard(group: str) -> InlineKeyboardMarkup:
 # =========================
 # 💬 КЛАВИАТУРА ЧАТА (мобильная)
 # =========================
-def get_chat_keyboard() -> InlineKeyboardMarkup:
+def _build_chat_keyboard() -> InlineKeyboardMarkup:
     # На телефоне лучше, когда не всё в одной широкой строке
     rows = [
         [
@@ -88,10 +127,14 @@ def get_chat_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+def get_chat_keyboard() -> InlineKeyboardMarkup:
+    return _CHAT_KEYBOARD
+
+
 # =========================
 # ✍️ СОАВТОРСТВО (мобильное)
 # =========================
-def get_cowrite_mode_keyboard() -> InlineKeyboardMarkup:
+def _build_cowrite_mode_keyboard() -> InlineKeyboardMarkup:
     rows = [
         [
             InlineKeyboardButton(text="📝 Рассказ", callback_data="cowrite_prose"),
@@ -102,3 +145,12 @@ def get_cowrite_mode_keyboard() -> InlineKeyboardMarkup:
         ],
     ]
     return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def get_cowrite_mode_keyboard() -> InlineKeyboardMarkup:
+    return _COWRITE_MODE_KEYBOARD
+
+
+# статичные клавиатуры — один объект на процесс
+_CHAT_KEYBOARD = _build_chat_keyboard()
+_COWRITE_MODE_KEYBOARD = _build_cowrite_mode_keyboard()
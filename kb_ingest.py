@@ -0,0 +1,433 @@
+# kb_ingest.py
+# Потоковая загрузка длинных текстов в базу знаний (kb/<author_key>.jsonl).
+#
+# Источники раскладываются по папкам авторов:
+#   sources/
+#     filatov/
+#       biography.txt        — обычный текст, абзацы через пустую строку;
+#                              строка-заголовок ("## Поэмы", "2. Лицей", "IV. ССЫЛКА", "ДЕТСТВО") —
+#                              тег всех чанков раздела, в текст не попадает
+#       fragments.jsonl      — {"text": "...", "tags": [...]} построчно
+# Имя папки — ключ автора из authors.AUTHORS, иначе загрузка не начнётся.
+#
+# Запуск:
+#   python kb_ingest.py sources
+#   python kb_ingest.py sources --out kb --chunk-chars 700 --overlap-chars 150
+#
+# Конвейер на генераторах: normalize -> chunk -> sanitize -> tag -> dedup -> запись.
+# В памяти одновременно только текущий абзац/чанк, поэтому размер входа не важен.
+# Повторный запуск обрабатывает только изменившиеся файлы (см. .ingest_manifest.json).
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from authors import AUTHORS
+from knowledge_base import KB_DIR, shard_path, strip_bad_lines, _tokenize
+
+MANIFEST_NAME = ".ingest_manifest.json"
+SOURCE_EXTS = (".txt", ".jsonl")
+
+CHUNK_CHARS = 700
+OVERLAP_CHARS = 150
+MIN_CHUNK_CHARS = 80
+
+# Автотеги: если в чанке есть слово-подсказка — ставим тег из словаря базы
+TAG_RULES: Dict[str, Tuple[str, ...]] = {
+    "биография": ("родился", "родилась", "детство", "учился", "умер", "семья", "жизнь"),
+    "произведения": ("роман", "поэма", "повесть", "рассказ", "пьеса", "сборник", "написал"),
+    "стиль": ("стиль", "манера", "язык", "интонац", "ирони", "слог"),
+    "темы": ("тема", "мотив", "смысл", "идея", "ценност"),
+}
+TOP_WORDS_AS_TAGS = 3
+MIN_TAG_WORD_LEN = 5
+
+# Заголовок раздела в .txt: одна строка не длиннее стольких символов в явной форме заголовка
+HEADING_MAX_CHARS = 60
+
+
+# =========================
+# Чтение источников
+# =========================
+# явные формы: "# Поэмы", "2. Лицей", "IV) Ссылка"; третья — строка целиком заглавными
+_heading_md_re = re.compile(r"^#+\s*(.+)$")
+_heading_num_re = re.compile(r"^(?:\d+|[IVXLC]+)[.)]\s+(.+)$")
+
+
+def _heading_tag(lines: List[str]) -> Optional[str]:
+    """
+    Тег раздела, если абзац — заголовок, иначе None. Короткая строка без точки сама по себе
+    заголовком не считается: это и стихи, и реплики, и подписи.
+    """
+    if len(lines) != 1:
+        return None
+    line = lines[0].strip()
+    if not line or len(line) > HEADING_MAX_CHARS:
+        return None
+    md = _heading_md_re.match(line)
+    title = md.group(1).strip() if md else line
+    num = _heading_num_re.match(title)
+    if num:
+        title = num.group(1)
+    elif not md and not (sum(ch.isalpha() for ch in line) >= 2 and line == line.upper()):
+        return None
+    tag = title.strip().rstrip(":.").strip().lower().replace("ё", "е")
+    return tag or None
+
+
+def _iter_paragraphs(path: str) -> Iterator[Tuple[str, List[str]]]:
+    """
+    (текст, теги) по одному абзацу/строке. Файл не читается целиком.
+    В .txt тег последнего заголовка ставится на все абзацы до следующего заголовка.
+    """
+    if path.endswith(".jsonl"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                text = (row.get("text") or "").strip()
+                if text:
+                    yield text, list(row.get("tags") or [])
+        return
+
+    buf: List[str] = []
+    section: List[str] = []
+
+    def paragraph() -> Optional[Tuple[str, List[str]]]:
+        nonlocal section
+        heading = _heading_tag(buf)
+        if heading:
+            section = [heading]
+            return None
+        return "\n".join(buf), list(section)
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                buf.append(line.rstrip("\n"))
+                continue
+            if buf:
+                item = paragraph()
+                if item:
+                    yield item
+                buf = []
+    if buf:
+        item = paragraph()
+        if item:
+            yield item
+
+
+# =========================
+# Стадии конвейера
+# =========================
+_spaces_re = re.compile(r"[ \t\u00a0]+")
+_sentence_end_re = re.compile(r"(?<=[.!?…])\s+")
+
+
+def normalize(paragraphs: Iterable[Tuple[str, List[str]]]) -> Iterator[Tuple[str, List[str]]]:
+    for text, tags in paragraphs:
+        text = text.replace("\r", "").replace("\u00ad", "")
+        # переносы внутри абзаца — просто пробел, строки абзаца склеиваем
+        text = _spaces_re.sub(" ", " ".join(part.strip() for part in text.split("\n"))).strip()
+        if text:
+            yield text, tags
+
+
+def chunk(
+    paragraphs: Iterable[Tuple[str, List[str]]],
+    chunk_chars: int = CHUNK_CHARS,
+    overlap_chars: int = OVERLAP_CHARS,
+) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Склеивает предложения в чанки ~chunk_chars с перекрытием ~overlap_chars.
+    Теги абзаца (ручные из jsonl, заголовок раздела из txt) получает каждый чанк,
+    в который попало хоть одно его предложение, — в том числе второй и дальше.
+    """
+    window: List[Tuple[str, List[str]]] = []  # (предложение, теги его абзаца)
+    size = 0
+    fresh = 0  # предложений после последнего чанка (не считая перекрытия)
+
+    def flush() -> Optional[Tuple[str, List[str]]]:
+        text = " ".join(sentence for sentence, _tags in window).strip()
+        if len(text) < MIN_CHUNK_CHARS:
+            return None
+        return text, list(dict.fromkeys(tag for _sentence, tags in window for tag in tags))
+
+    for text, para_tags in paragraphs:
+        for sentence in _sentence_end_re.split(text):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            window.append((sentence, para_tags))
+            size += len(sentence) + 1
+            fresh += 1
+            if size < chunk_chars:
+                continue
+
+            out = flush()
+            if out:
+                yield out
+
+            # перекрытие: хвост из последних предложений (вместе с их тегами)
+            tail: List[Tuple[str, List[str]]] = []
+            tail_size = 0
+            for prev in reversed(window):
+                if tail_size + len(prev[0]) > overlap_chars:
+                    break
+                tail.insert(0, prev)
+                tail_size += len(prev[0]) + 1
+            window = tail
+            size = tail_size
+            fresh = 0
+
+    if fresh:
+        out = flush()
+        if out:
+            yield out
+
+
+def auto_tag(chunks: Iterable[Tuple[str, List[str]]]) -> Iterator[Tuple[str, List[str]]]:
+    for text, tags in chunks:
+        text_l = text.lower()
+        out = list(tags)
+        for tag, cues in TAG_RULES.items():
+            if tag not in out and any(c in text_l for c in cues):
+                out.append(tag)
+        words = Counter(t for t in _tokenize(text) if len(t) >= MIN_TAG_WORD_LEN)
+        for word, _cnt in words.most_common(TOP_WORDS_AS_TAGS):
+            if word not in out:
+                out.append(word)
+        yield text, out
+
+
+def sanitize(chunks: Iterable[Tuple[str, List[str]]]) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Правила _strip_rag, но по предложениям: после normalize чанк — одна строка,
+    и выкидывать его целиком из-за одной фразы было бы слишком грубо.
+    """
+    for text, tags in chunks:
+        text = " ".join(strip_bad_lines("\n".join(_sentence_end_re.split(text))).split("\n")).strip()
+        if len(text) >= MIN_CHUNK_CHARS:
+            yield text, tags
+
+
+def text_hash(text: str) -> str:
+    # весь текст, а не токены поиска: _tokenize теряет короткие слова и числа,
+    # и "не писал" / "писал" склеились бы в один чанк
+    norm = " ".join((text or "").casefold().split())
+    return hashlib.blake2b(norm.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def dedup(chunks: Iterable[Tuple[str, List[str]]], seen: Set[str]) -> Iterator[Tuple[str, List[str], str]]:
+    for text, tags in chunks:
+        h = text_hash(text)
+        if h in seen:
+            continue
+        seen.add(h)
+        yield text, tags, h
+
+
+def pipeline(path: str, seen: Set[str], chunk_chars: int, overlap_chars: int) -> Iterator[Tuple[str, List[str], str]]:
+    stream = normalize(_iter_paragraphs(path))
+    stream = chunk(stream, chunk_chars, overlap_chars)
+    stream = sanitize(stream)  # до тегов: иначе теги "вспомнят" выброшенные фразы
+    stream = auto_tag(stream)
+    return dedup(stream, seen)
+
+
+# =========================
+# Манифест и инкрементальность
+# =========================
+def _file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _load_manifest(out_dir: str) -> Dict[str, dict]:
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _save_manifest(out_dir: str, manifest: Dict[str, dict]) -> None:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _scan_sources(src_dir: str) -> Dict[str, Tuple[str, str]]:
+    """
+    rel_path -> (author_key, abs_path)
+    Папка с неизвестным ключом автора — ValueError: шард под опечатку бот никогда не прочтёт.
+    """
+    author_dirs = [name for name in sorted(os.listdir(src_dir)) if os.path.isdir(os.path.join(src_dir, name))]
+    unknown = [name for name in author_dirs if name not in AUTHORS]
+    if unknown:
+        raise ValueError(
+            f"неизвестные авторы в {src_dir}: {', '.join(unknown)}; "
+            f"имя папки должно быть ключом из authors.AUTHORS ({', '.join(sorted(AUTHORS))})"
+        )
+
+    out: Dict[str, Tuple[str, str]] = {}
+    for author_key in author_dirs:
+        author_dir = os.path.join(src_dir, author_key)
+        for root, _dirs, files in os.walk(author_dir):
+            for name in sorted(files):
+                if name.endswith(SOURCE_EXTS):
+                    abs_path = os.path.join(root, name)
+                    rel = os.path.relpath(abs_path, src_dir).replace(os.sep, "/")
+                    out[rel] = (author_key, abs_path)
+    return out
+
+
+def _changed_sources(
+    sources: Dict[str, Tuple[str, str]],
+    manifest: Dict[str, dict],
+    out_dir: str,
+) -> Tuple[Dict[str, dict], Set[str]]:
+    """
+    Возвращает новые записи манифеста для изменившихся файлов и множество удалённых.
+    Сначала сверяем размер и mtime, хэш считаем только если они поменялись.
+    Если шард автора пропал — все его источники считаются изменившимися.
+    """
+    changed: Dict[str, dict] = {}
+    for rel, (author_key, abs_path) in sources.items():
+        st = os.stat(abs_path)
+        prev = manifest.get(rel) or {}
+        if not os.path.exists(shard_path(author_key, out_dir)):
+            prev = {}
+        if prev.get("size") == st.st_size and prev.get("mtime") == int(st.st_mtime) and prev.get("author") == author_key:
+            continue
+        sha = _file_sha1(abs_path)
+        entry = {"author": author_key, "size": st.st_size, "mtime": int(st.st_mtime), "sha1": sha}
+        if prev.get("sha1") == sha and prev.get("author") == author_key:
+            manifest[rel] = entry  # только "потрогали" файл — переиндексация не нужна
+            continue
+        changed[rel] = entry
+
+    removed = {rel for rel in manifest if rel not in sources}
+    return changed, removed
+
+
+# =========================
+# Запись шарда
+# =========================
+def rebuild_shard(
+    author_key: str,
+    out_dir: str,
+    drop_sources: Set[str],
+    new_sources: List[Tuple[str, str]],
+    chunk_chars: int,
+    overlap_chars: int,
+) -> Tuple[int, int]:
+    """
+    Переписывает шард автора потоково: старые строки из неизменившихся источников
+    (и ручные строки без source) копируются как есть, затем дописываются новые чанки.
+    Возвращает (сохранено старых, добавлено новых).
+    """
+    path = shard_path(author_key, out_dir)
+    tmp = path + ".tmp"
+    seen: Set[str] = set()
+    kept = 0
+    added = 0
+
+    with open(tmp, "w", encoding="utf-8") as out:
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    if row.get("source") in drop_sources:
+                        continue
+                    # хэш пересчитываем: в старых строках он мог быть посчитан по-другому
+                    seen.add(text_hash(row.get("text", "")))
+                    out.write(line if line.endswith("\n") else line + "\n")
+                    kept += 1
+
+        for rel, abs_path in new_sources:
+            for text, tags, h in pipeline(abs_path, seen, chunk_chars, overlap_chars):
+                row = {"text": text, "tags": tags, "source": rel, "hash": h, "sanitized": True}
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                added += 1
+
+    os.replace(tmp, path)
+    return kept, added
+
+
+def ingest(
+    src_dir: str,
+    out_dir: str = KB_DIR,
+    chunk_chars: int = CHUNK_CHARS,
+    overlap_chars: int = OVERLAP_CHARS,
+) -> Dict[str, Tuple[int, int]]:
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = _load_manifest(out_dir)
+    sources = _scan_sources(src_dir)
+    changed, removed = _changed_sources(sources, manifest, out_dir)
+
+    touched_authors: Dict[str, Tuple[Set[str], List[Tuple[str, str]]]] = {}
+    for rel in removed:
+        author_key = manifest[rel].get("author")
+        if author_key:
+            touched_authors.setdefault(author_key, (set(), []))[0].add(rel)
+    for rel, entry in changed.items():
+        drop, new = touched_authors.setdefault(entry["author"], (set(), []))
+        drop.add(rel)
+        prev_author = (manifest.get(rel) or {}).get("author")
+        if prev_author and prev_author != entry["author"]:
+            touched_authors.setdefault(prev_author, (set(), []))[0].add(rel)
+        new.append((rel, sources[rel][1]))
+
+    report: Dict[str, Tuple[int, int]] = {}
+    for author_key, (drop, new) in sorted(touched_authors.items()):
+        report[author_key] = rebuild_shard(author_key, out_dir, drop, new, chunk_chars, overlap_chars)
+
+    for rel in removed:
+        manifest.pop(rel, None)
+    manifest.update(changed)
+    _save_manifest(out_dir, manifest)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Загрузка текстов в базу знаний (kb/<author>.jsonl)")
+    parser.add_argument("src", help="папка с источниками: <src>/<author_key>/*.txt|*.jsonl")
+    parser.add_argument("--out", default=KB_DIR, help="куда писать шарды (по умолчанию KB_DIR)")
+    parser.add_argument("--chunk-chars", type=int, default=CHUNK_CHARS)
+    parser.add_argument("--overlap-chars", type=int, default=OVERLAP_CHARS)
+    args = parser.parse_args()
+
+    try:
+        report = ingest(args.src, args.out, args.chunk_chars, args.overlap_chars)
+    except ValueError as e:
+        parser.error(str(e))
+    if not report:
+        print("Изменений нет.")
+        return
+    for author_key, (kept, added) in report.items():
+        print(f"{author_key}: оставлено {kept}, добавлено {added}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,23 @@
 # knowledge_base.py
 from __future__ import annotations
 
+from collections import Counter, OrderedDict
 from dataclasses import dataclass
-from typing import List
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import heapq
+import json
+import math
+import os
 import re
+import threading
+import zlib
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
 
 
 @dataclass
@@ -11,46 +25,7 @@ class KBItem:
     author_key: str
     text: str
     tags: List[str]
-
-
-# =========================
-# RAG-база (фрагменты по авторам)
-# =========================
-
-KB: List[KBItem] = [
-    KBItem(
-        author_key="filatov",
-        tags=["биография", "кто такой", "жизнь", "актер", "режиссер", "драматург"],
-        text=(
-            "Леонид Алексеевич Филатов — актёр, режиссёр, поэт, драматург и публицист. "
-            "Его часто вспоминают за сочетание сценической выразительности и точной иронии."
-        ),
-    ),
-    KBItem(
-        author_key="filatov",
-        tags=["произведения", "что написал", "федот", "главное", "поэма"],
-        text=(
-            "Одно из самых известных произведений Филатова — сатирическая поэма "
-            "«Про Федота-стрельца, удалого молодца»: ирония, живой язык, социальные намёки."
-        ),
-    ),
-    KBItem(
-        author_key="filatov",
-        tags=["стиль", "манера", "ирония", "сатира", "речь", "язык"],
-        text=(
-            "Манера Филатова: умная ирония без грубости, точные формулировки и чувство меры. "
-            "Даже в сатире слышна ответственность за слово."
-        ),
-    ),
-    KBItem(
-        author_key="filatov",
-        tags=["темы", "смысл", "о чем", "позиция", "ценности"],
-        text=(
-            "Филатову близки темы честности, внутреннего достоинства и цены слова, "
-            "а также сатирический взгляд на общественные привычки и власть языка."
-        ),
-    ),
-]
+    sanitized: bool = False  # уже прошёл strip_bad_lines (при загрузке в базу)
 
 
 _word_re = re.compile(r"[а-яёa-z0-9]+", re.IGNORECASE)
@@ -68,11 +43,472 @@ def _tokenize(text: str) -> List[str]:
     return [t for t in tokens if len(t) >= 3]
 
 
+# =========================
+# Санитизация: RAG не должен "переназначать" роль модели
+# =========================
+RAG_BAD_MARKERS = (
+    "ты —", "ты-", "system:", "system prompt", "роль:", "инструкция",
+    "выдай себя за", "представься как", "ты являешься", "ты — фёдор", "ты — леонид"
+)
+
+# Все маркеры — одним regex; маркеры в нижнем регистре, поэтому ищем по text.lower()
+# (так быстрее, чем re.IGNORECASE)
+BAD_MARKER_RE = re.compile("|".join(re.escape(m) for m in RAG_BAD_MARKERS))
+
+
+def strip_bad_lines(text: str) -> str:
+    """
+    Убирает целиком строки, где встречается любой из RAG_BAD_MARKERS.
+    Чистый текст (обычный случай) проверяется за один проход regex.
+    """
+    if not text:
+        return ""
+    if not BAD_MARKER_RE.search(text.lower()):
+        return text
+    return "\n".join(line for line in text.splitlines() if not BAD_MARKER_RE.search(line.lower()))
+
+
+# =========================
+# BM25 поверх инвертированного индекса
+# =========================
+# Раньше слово запроса искалось подстрокой в тексте, поэтому "стиль" находил и "стильный".
+# Чтобы не терять это, индексируем все префиксы токенов длиной >= 3.
+MIN_KEY_LEN = 3
+
+# Совпадение в тегах весомее, чем в тексте (как и раньше: 3 против 2)
+TAGS_BOOST = 1.5
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# =========================
+# Плотный поиск: хэшированные символьные n-граммы + TF-IDF, без внешних моделей
+# =========================
+# bm25 — только ключевые слова; hybrid — смешиваем BM25 и косинус по n-граммам
+KB_RETRIEVAL_MODE = os.getenv("KB_RETRIEVAL_MODE", "bm25").strip().lower()
+DENSE_DIM = int(os.getenv("KB_DENSE_DIM", "2048"))
+DENSE_NGRAM = 3
+HYBRID_ALPHA = 0.5      # доля косинуса в итоговом скоре
+DENSE_MIN_SIM = 0.1     # слабее — считаем шумом, а не перефразом
+
+
+def _char_ngram_counts(text: str) -> Counter:
+    counts: Counter = Counter()
+    for token in _word_re.findall((text or "").lower().replace("ё", "е")):
+        padded = f" {token} "
+        for i in range(len(padded) - DENSE_NGRAM + 1):
+            counts[zlib.crc32(padded[i:i + DENSE_NGRAM].encode("utf-8")) % DENSE_DIM] += 1
+    return counts
+
+
+def _prefix_counts(tokens: List[str]) -> Counter:
+    counts: Counter = Counter()
+    for token in tokens:
+        for i in range(MIN_KEY_LEN, len(token) + 1):
+            counts[token[:i]] += 1
+    return counts
+
+
+class AuthorIndex:
+    """
+    Индекс фрагментов одного автора.
+    IDF и длины документов считаются один раз, а итоговый BM25-вес каждой пары
+    (ключ, фрагмент) хранится прямо в списке — запрос только складывает готовые веса.
+    """
+
+    def __init__(
+        self,
+        texts: List[str],
+        tags: List[List[str]],
+        docs: Optional[Sequence[str]] = None,
+        dense: Optional[bool] = None,
+    ):
+        # docs — откуда отдавать тексты на выдаче (по умолчанию сами texts, для шардов — байты файла)
+        self.docs = docs if docs is not None else texts
+        n_docs = len(texts)
+
+        tfs: List[Dict[str, float]] = []
+        doc_len: List[float] = []
+        for text, doc_tags in zip(texts, tags):
+            text_tokens = _tokenize(text)
+            tag_tokens = _tokenize(" ".join(doc_tags))
+            tf: Dict[str, float] = dict(_prefix_counts(text_tokens))
+            for key, cnt in _prefix_counts(tag_tokens).items():
+                tf[key] = tf.get(key, 0.0) + TAGS_BOOST * cnt
+            tfs.append(tf)
+            doc_len.append(len(text_tokens) + TAGS_BOOST * len(tag_tokens))
+
+        avgdl = (sum(doc_len) / n_docs) if n_docs else 1.0
+        avgdl = avgdl or 1.0
+
+        df: Counter = Counter()
+        for tf in tfs:
+            df.update(tf.keys())
+
+        self.idf: Dict[str, float] = {
+            key: math.log(1.0 + (n_docs - cnt + 0.5) / (cnt + 0.5)) for key, cnt in df.items()
+        }
+
+        postings: Dict[str, Tuple[List[int], List[float]]] = {}
+        for doc_id, (tf, dl) in enumerate(zip(tfs, doc_len)):
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl)
+            for key, f in tf.items():
+                weight = self.idf[key] * f * (BM25_K1 + 1.0) / (f + norm)
+                ids, weights = postings.setdefault(key, ([], []))
+                ids.append(doc_id)
+                weights.append(weight)
+
+        if NUMPY_AVAILABLE:
+            self.doc_len = np.asarray(doc_len, dtype=np.float32)
+            self.postings = {
+                key: (np.asarray(ids, dtype=np.int32), np.asarray(weights, dtype=np.float32))
+                for key, (ids, weights) in postings.items()
+            }
+        else:
+            self.doc_len = doc_len
+            self.postings = postings
+
+        if dense is None:
+            dense = KB_RETRIEVAL_MODE == "hybrid"
+        self.dense_matrix = None
+        self.dense_idf = None
+        if dense and NUMPY_AVAILABLE and n_docs:
+            self._build_dense(texts, tags)
+
+    def _build_dense(self, texts: List[str], tags: List[List[str]]) -> None:
+        matrix = np.zeros((len(texts), DENSE_DIM), dtype=np.float32)
+        for doc_id, (text, doc_tags) in enumerate(zip(texts, tags)):
+            counts = _char_ngram_counts(text + " " + " ".join(doc_tags))
+            if counts:
+                cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+                vals = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+                matrix[doc_id, cols] = 1.0 + np.log(vals)
+
+        df = np.count_nonzero(matrix, axis=0).astype(np.float32)
+        idf = (np.log((1.0 + len(texts)) / (1.0 + df)) + 1.0).astype(np.float32)
+        matrix *= idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.maximum(norms, 1e-12)
+
+        self.dense_matrix = matrix
+        self.dense_idf = idf
+
+    def _bm25_scores(self, words: List[str]):
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for w in words:
+            hit = self.postings.get(w)
+            if hit is not None:
+                ids, weights = hit
+                scores[ids] += weights  # внутри одного списка номера уникальны
+        return scores
+
+    def _dense_scores(self, query: str):
+        counts = _char_ngram_counts(query)
+        q = np.zeros(DENSE_DIM, dtype=np.float32)
+        if counts:
+            cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            vals = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            q[cols] = 1.0 + np.log(vals)
+        q *= self.dense_idf
+        norm = float(np.linalg.norm(q))
+        if norm == 0.0:
+            return np.zeros(len(self.docs), dtype=np.float32)
+        sims = self.dense_matrix @ (q / norm)
+        sims[sims < DENSE_MIN_SIM] = 0.0
+        return sims
+
+    def _top(self, scores, limit: int) -> List[str]:
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > limit:
+            top = np.argpartition(-scores[matched], limit - 1)[:limit]
+            matched = matched[top]
+        # стабильный порядок: по очкам, при равенстве — по порядку в базе
+        order = np.lexsort((matched, -scores[matched]))
+        return [self.docs[int(i)] for i in matched[order]]
+
+    def search_hybrid(self, query: str, words: List[str], limit: int) -> List[str]:
+        """
+        BM25 + косинус по символьным n-граммам: ловит словоформы и перефразы,
+        которые не совпадают с ключами индекса.
+        """
+        if self.dense_matrix is None:
+            return self.search(words, limit)
+
+        bm25 = self._bm25_scores(words)
+        top_bm25 = float(bm25.max()) if len(bm25) else 0.0
+        if top_bm25 > 0:
+            bm25 /= top_bm25
+        scores = (1.0 - HYBRID_ALPHA) * bm25 + HYBRID_ALPHA * self._dense_scores(query)
+        return self._top(scores, limit)
+
+    def search(self, words: List[str], limit: int) -> List[str]:
+        if NUMPY_AVAILABLE:
+            return self._top(self._bm25_scores(words), limit)
+
+        hits = [self.postings[w] for w in words if w in self.postings]
+        if not hits:
+            return []
+
+        acc: Dict[int, float] = {}
+        for ids, weights in hits:
+            for doc_id, weight in zip(ids, weights):
+                acc[doc_id] = acc.get(doc_id, 0.0) + weight
+        best = heapq.nsmallest(limit, acc.items(), key=lambda x: (-x[1], x[0]))
+        return [self.docs[doc_id] for doc_id, score in best if score > 0]
+
+
+def build_index(items: List[KBItem]) -> Dict[str, AuthorIndex]:
+    """
+    Индекс по готовому списку фрагментов (ручная сборка, бенчмарки).
+    Тексты и теги нормализуются заранее, на запросе трогаются только списки по словам запроса.
+    """
+    grouped: Dict[str, Tuple[List[str], List[List[str]]]] = {}
+    for item in items:
+        texts, tags = grouped.setdefault(item.author_key, ([], []))
+        texts.append(item.text if item.sanitized else strip_bad_lines(item.text).strip())
+        tags.append(item.tags)
+    return {akey: AuthorIndex(texts, tags) for akey, (texts, tags) in grouped.items()}
+
+
+# =========================
+# RAG-база на диске: один шард на автора — kb/<author_key>.jsonl
+# строка шарда: {"text": "...", "tags": ["...", ...]}
+# =========================
+KB_DIR = os.getenv("KB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "kb"))
+
+_author_key_re = re.compile(r"^[a-z0-9_\-]+$")
+
+
+def shard_path(author_key: str, kb_dir: Optional[str] = None) -> str:
+    return os.path.join(kb_dir or KB_DIR, f"{author_key}.jsonl")
+
+
+class ShardDocs(Sequence[str]):
+    """
+    Тексты шарда из копии файла в памяти: держим одни байты и смещения строк,
+    текст декодируется, когда фрагмент попал в выдачу.
+    Копия, а не mmap: шард правят руками, и усечение файла на месте под mmap — это SIGBUS,
+    а перезапись — чтение мусора по старым смещениям.
+    Строки без флага sanitized, которые санитизация изменила, лежат в overrides.
+    """
+
+    def __init__(self, buf: bytes, offsets: array, overrides: Optional[Dict[int, str]] = None):
+        self._buf = buf
+        self._offsets = offsets
+        self._overrides = overrides or {}
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        override = self._overrides.get(i)
+        if override is not None:
+            return override
+        start = self._offsets[i]
+        end = self._buf.find(b"\n", start)
+        line = self._buf[start:end if end != -1 else len(self._buf)]
+        return json.loads(line).get("text", "")
+
+
+def _iter_shard_lines(buf) -> Iterator[Tuple[int, bytes]]:
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        end = buf.find(b"\n", pos)
+        if end == -1:
+            end = size
+        yield pos, buf[pos:end]
+        pos = end + 1
+
+
+def load_shard(author_key: str, kb_dir: Optional[str] = None) -> Optional[AuthorIndex]:
+    """
+    Читает шард автора и строит по нему индекс.
+    Файл читается целиком один раз: тексты на выдаче берутся из этой копии (ShardDocs),
+    так что правка или усечение шарда на диске не трогает уже загруженный индекс.
+    Строки без флага "sanitized" (ручные правки шарда) санитизируются здесь, один раз.
+    """
+    if not _author_key_re.match(author_key or ""):
+        return None
+
+    path = shard_path(author_key, kb_dir)
+    try:
+        with open(path, "rb") as f:
+            buf = f.read()
+    except OSError:
+        return None
+
+    texts: List[str] = []
+    tags: List[List[str]] = []
+    offsets = array("Q")
+    overrides: Dict[int, str] = {}
+    for offset, line in _iter_shard_lines(buf):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        raw = row.get("text") or ""
+        text = raw.strip() if row.get("sanitized") else strip_bad_lines(raw).strip()
+        if not text:
+            continue
+        if text != raw:
+            overrides[len(texts)] = text
+        texts.append(text)
+        tags.append(list(row.get("tags") or []))
+        offsets.append(offset)
+
+    if not texts:
+        return None
+
+    return AuthorIndex(texts, tags, docs=ShardDocs(buf, offsets, overrides))
+
+
+# =========================
+# Кэш индексов и горячая перезагрузка
+# =========================
+# author_key -> (индекс или None, если шарда нет; (mtime_ns, size) шарда на момент загрузки).
+# Заполняется лениво, при первом запросе по автору. При перезагрузке новый словарь
+# собирается целиком и подменяется одним присваиванием — поиск либо видит старый индекс,
+# либо уже готовый новый, но никогда не полусобранный.
+ShardStamp = Optional[Tuple[int, int]]
+
+_INDEX: Dict[str, Tuple[Optional[AuthorIndex], ShardStamp]] = {}
+_INDEX_LOCK = threading.Lock()
+_RELOAD_LOCK = threading.Lock()
+_KB_VERSION = 0
+
+
+def kb_version() -> int:
+    """Растёт при каждой перезагрузке базы — для кэшей поверх rag_search."""
+    return _KB_VERSION
+
+
+def _shard_stamp(author_key: str) -> ShardStamp:
+    try:
+        st = os.stat(shard_path(author_key))
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def is_index_loaded(author_key: str) -> bool:
+    """Индекс автора уже в памяти (или известно, что шарда нет) — поиск не тронет диск."""
+    return author_key in _INDEX
+
+
+def prewarm_kb(author_keys: Sequence[str]) -> int:
+    """
+    Загрузить шарды заранее (при старте, из фонового потока), чтобы первый запрос
+    по автору не строил индекс. Возвращает, сколько индексов в памяти.
+    """
+    loaded = 0
+    for author_key in author_keys:
+        if get_author_index(author_key) is not None:
+            loaded += 1
+    return loaded
+
+
+def get_author_index(author_key: str) -> Optional[AuthorIndex]:
+    entry = _INDEX.get(author_key)
+    if entry is not None:
+        return entry[0]
+
+    with _INDEX_LOCK:
+        if author_key not in _INDEX:
+            stamp = _shard_stamp(author_key)  # до чтения: правка во время загрузки не потеряется
+            _INDEX[author_key] = (load_shard(author_key), stamp)
+        return _INDEX[author_key][0]
+
+
+def reload_kb(force: bool = False) -> List[str]:
+    """
+    Перечитывает изменившиеся шарды уже загруженных авторов (force — все загруженные).
+    Дорогая часть (чтение + индекс) идёт без блокировки поиска; вызывать из фонового потока.
+    Возвращает список перезагруженных авторов.
+    """
+    global _INDEX, _KB_VERSION
+
+    with _RELOAD_LOCK:
+        current = _INDEX
+        rebuilt: Dict[str, Tuple[Optional[AuthorIndex], ShardStamp]] = {}
+        for author_key, (_index, stamp) in list(current.items()):
+            new_stamp = _shard_stamp(author_key)
+            if force or new_stamp != stamp:
+                rebuilt[author_key] = (load_shard(author_key), new_stamp)
+
+        if not rebuilt:
+            return []
+
+        with _INDEX_LOCK:
+            fresh = dict(_INDEX)  # вместе с авторами, лениво загруженными за время сборки
+            fresh.update(rebuilt)
+            _INDEX = fresh
+            _KB_VERSION += 1
+
+        # ключи с прошлой версией уже не совпадут — просто освобождаем память
+        _RAG_CACHE.clear()
+
+        return sorted(rebuilt)
+
+
+# =========================
+# Кэш результатов RAG: (автор, токены запроса, версия базы)
+# =========================
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "2048"))
+
+_MISS = object()
+
+
+class _LRU:
+    def __init__(self, maxsize: int):
+        self.maxsize = max(0, int(maxsize))
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key, _MISS)
+            if value is not _MISS:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_RAG_CACHE = _LRU(KB_CACHE_SIZE)
+
+
+def _query_key(query: str, words: List[str]) -> Tuple[str, ...]:
+    """
+    Ключ запроса без учёта порядка слов. В режиме hybrid важны и короткие слова (n-граммы),
+    поэтому там берём все слова, а не только токены индекса.
+    """
+    if KB_RETRIEVAL_MODE == "hybrid":
+        return tuple(sorted(_word_re.findall((query or "").lower().replace("ё", "е"))))
+    return tuple(sorted(words))
+
+
 def rag_search(author_key: str, query: str, limit: int = 7) -> List[str]:
     """
     Простая RAG-поисковая функция:
-    - ищем совпадения по токенам запроса в KBItem.text и KBItem.tags
-    - возвращаем топ-N фрагментов
+    - ищем токены запроса в индексе автора (текст + теги)
+    - ранжируем по BM25 только найденные фрагменты (в режиме hybrid — вместе с косинусом по n-граммам)
+    - возвращаем топ-N фрагментов (без кэша: кэшируется готовая СПРАВКА в rag_context)
     """
     author_key = (author_key or "").strip()
     if not author_key:
@@ -82,26 +518,28 @@ def rag_search(author_key: str, query: str, limit: int = 7) -> List[str]:
     if not words:
         return []
 
-    scored = []
-    for item in KB:
-        if item.author_key != author_key:
-            continue
-
-        text_l = item.text.lower()
-        tags_l = " ".join(item.tags).lower()
-
-        score = 0
-        for w in words:
-            if w in text_l:
-                score += 2
-            if w in tags_l:
-                score += 3
+    limit = max(1, int(limit))
+    author_index = get_author_index(author_key)
+    if not author_index:
+        return []
+    if KB_RETRIEVAL_MODE == "hybrid":
+        return author_index.search_hybrid(query, words, limit)
+    return author_index.search(words, limit)
 
-        if score > 0:
-            scored.append((score, item.text))
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [t for _, t in scored[: max(1, int(limit))]]
+def rag_context(author_key: str, query: str, limit: int = 7, max_chars: int = 2200) -> str:
+    """
+    Готовый текст СПРАВКИ для промпта: rag_search + format_rag_blocks, с кэшем.
+    Ключ — нормализованные токены запроса и версия базы: повтор и перестановка слов
+    обходятся без поиска и форматирования.
+    """
+    author_key = (author_key or "").strip()
+    key = (_KB_VERSION, author_key, _query_key(query, _tokenize(query)), limit, max_chars)
+    text = _RAG_CACHE.get(key)
+    if text is _MISS:
+        text = format_rag_blocks(rag_search(author_key, query, limit=limit), max_chars=max_chars).strip()
+        _RAG_CACHE.put(key, text)
+    return text
 
 
 def format_rag_blocks(blocks: List[str], max_chars: int = 2200) -> str:
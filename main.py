@@ -1,32 +1,66 @@
 # main.py
 import os
 import asyncio
+import hashlib
 import logging
 import atexit
 import signal
 import time
-from typing import Set, Any, Dict
+from contextlib import contextmanager
+from typing import Set, Any, Dict, List, Optional
 
 from aiohttp import web
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import InlineKeyboardButton
 
-from config import BOT_TOKEN
-from database import db
+from config import (
+    BOT_TOKEN,
+    GIGACHAT_MODEL,
+    ROLLING_SUMMARY,
+    RATE_LIMIT_BACKEND,
+    RATE_LIMIT_SQLITE_PATH,
+    RATE_LIMIT_REDIS_URL,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS,
+    DROP_PENDING_UPDATES,
+    BOT_WORKERS,
+)
+from database import db, RECENT_WINDOW_MESSAGES
 from authors import get_author, list_author_keys
 from inline_keyboards import (
     get_groups_keyboard,
     get_authors_keyboard,
     get_chat_keyboard,
     get_cowrite_mode_keyboard,
+    prebuild_keyboards,
 )
 from gigachat_client import gigachat_client
-from rate_limit import RateLimitConfig, InMemoryRateLimiter, AntiFloodMiddleware
+from upstream_limiter import upstream_limiter
+from broadcast import broadcasts
+from user_queue import user_ordering
+from sharding import ShardRouter, add_webhook_route, consume, poll_updates, shard_for, start_workers, stop_workers
+from knowledge_base import prewarm_kb, reload_kb
+from recognition import guess_authors_from_text, build_quick_author_keyboard
+from rate_limit import (
+    RateLimitConfig,
+    AntiFloodMiddleware,
+    CallbackFloodMiddleware,
+    build_rate_limiter,
+    estimate_cost,
+)
 
 
 logging.basicConfig(level=logging.INFO)
@@ -120,29 +154,109 @@ def _load_json(path: str, default: Any):
 
 def _save_json(path: str, obj: Any) -> None:
     import json
-    tmp = path + ".tmp"
+    tmp = f"{path}.{os.getpid()}.tmp"
     with open(tmp, "w", encoding="utf-8") as f:
         json.dump(obj, f, ensure_ascii=False, indent=2)
     os.replace(tmp, path)
 
 
+@contextmanager
+def _file_lock(path: str):
+    """
+    Межпроцессная блокировка файла (нужна при BOT_WORKERS > 1: users.json и stats.json
+    общие для всех воркеров). Без fcntl (Windows) — без блокировки, там воркер один.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _update_json(path: str, default: Any, mutate) -> Any:
+    """Прочитать-изменить-записать под блокировкой. mutate(obj) -> False, если писать не нужно."""
+    with _file_lock(path):
+        obj = _load_json(path, default)
+        if mutate(obj) is not False:
+            _save_json(path, obj)
+        return obj
+
+
+# ---------- общие файлы: изменения копятся в памяти ----------
+# users.json и stats.json общие для всех воркеров. Хендлеры их не трогают: track_user,
+# mark_seen, inc_* и deactivate_users только пишут в память процесса, а flush_shared_state
+# раз в STATS_FLUSH_SECONDS сливает накопленное в файлы — в потоке, под файловой блокировкой.
+STATS_FLUSH_SECONDS = float(os.getenv("STATS_FLUSH_SECONDS", "5"))
+
+_USER_STATS_KEYS = ("users_last_seen", "usernames", "first_names", "messages_by_user")
+
+
+class _SharedBatch:
+    """Изменения users.json / inactive_users.json / stats.json с прошлого слива."""
+
+    def __init__(self):
+        self.new_users: Set[int] = set()
+        self.restored: Set[int] = set()
+        self.deactivated: Dict[str, str] = {}  # user_id -> причина
+        self.deactivated_at = 0
+        self.last_seen: Dict[str, int] = {}
+        self.usernames: Dict[str, str] = {}
+        self.first_names: Dict[str, str] = {}
+        self.messages_total = 0
+        self.messages_by_user: Dict[str, int] = {}
+        self.commands: Dict[str, int] = {}
+        self.authors_selected: Dict[str, int] = {}
+
+    def forget(self, uid: str) -> None:
+        for bucket in (self.last_seen, self.usernames, self.first_names):
+            bucket.pop(uid, None)
+        self.messages_total -= self.messages_by_user.pop(uid, 0)
+
+
+class _SharedState:
+    def __init__(self):
+        self.batch = _SharedBatch()
+        self.known_users: Set[int] = set()
+        self.inactive: Set[str] = set()
+        # недоступные пользователи этого воркера, чей user_{id}.json уже в архиве (или его не было)
+        self.archived: Set[str] = set()
+        self.shard = (0, 1)  # (номер воркера, всего воркеров)
+        self.lock: Optional[asyncio.Lock] = None
+
+    def take(self) -> _SharedBatch:
+        batch, self.batch = self.batch, _SharedBatch()
+        return batch
+
+
+_shared = _SharedState()
+
+
 # ---------- users ----------
 def _users_path() -> str:
     return os.path.join(_data_dir(), "users.json")
 
 
 def track_user(user_id: int) -> None:
-    p = _users_path()
-    data = _load_json(p, {"users": []})
-    users = set()
-    for x in data.get("users", []):
-        try:
-            users.add(int(x))
-        except Exception:
-            pass
-    if int(user_id) not in users:
-        users.add(int(user_id))
-        _save_json(p, {"users": sorted(list(users))})
+    uid = int(user_id)
+    if uid in _shared.known_users:
+        return
+    _shared.known_users.add(uid)
+    batch = _shared.batch
+    batch.new_users.add(uid)
+    if batch.deactivated.pop(str(uid), None) is not None:
+        # недоступным отмечен в этой же пачке — просто не убираем
+        _shared.inactive.discard(str(uid))
+    elif str(uid) in _shared.inactive:
+        # вернулся тот, кто раньше заблокировал бота: user_{id}.json достаём из архива сразу
+        # (файл пользователя трогает только его воркер), статистику — при сливе
+        _shared.inactive.discard(str(uid))
+        _shared.archived.discard(str(uid))
+        batch.restored.add(uid)
+        _restore_user_data(uid)
 
 
 def get_all_users() -> list[int]:
@@ -156,6 +270,127 @@ def get_all_users() -> list[int]:
     return sorted(list(set(out)))
 
 
+# ---------- недоступные пользователи ----------
+# Кто заблокировал бота или удалил аккаунт, уходит из users.json в inactive_users.json
+# (с причиной), а его user_{id}.json и записи в stats.json — в data/archive/user_{id}.json.
+# Рассылки и track_user больше за них не платят; написал снова — всё возвращается.
+# Рассылка (и deactivate_users) живёт в воркере 0, а user_{id}.json — в воркере пользователя:
+# воркер 0 при сливе архивирует статистику, файл пользователя — его воркер при своём сливе,
+# в очереди апдейтов пользователя (user_ordering.hold).
+def _inactive_path() -> str:
+    return os.path.join(_data_dir(), "inactive_users.json")
+
+
+def _archive_path(user_id: int) -> str:
+    path = os.path.join(_data_dir(), "archive")
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, f"user_{int(user_id)}.json")
+
+
+def _update_archive(user_id: int, mutate) -> None:
+    # архив пишут воркер 0 (статистика) и воркер пользователя (его файл) — одна блокировка на папку
+    with _file_lock(os.path.join(_data_dir(), "archive")):
+        archived = _load_json(_archive_path(user_id), {}) or {}
+        mutate(archived)
+        _save_json(_archive_path(user_id), archived)
+
+
+def get_inactive_users() -> Dict[str, Any]:
+    """user_id (str) -> {"reason": ..., "at": unix_ts}"""
+    return _load_json(_inactive_path(), {"users": {}}).get("users", {}) or {}
+
+
+def deactivate_users(items: list[tuple[int, str]]) -> None:
+    """Убрать недоступных из рабочего набора: [(user_id, причина), ...]. Файлы — при следующем сливе."""
+    if not items:
+        return
+    batch = _shared.batch
+    batch.deactivated_at = int(time.time())
+    for uid, reason in items:
+        key = str(int(uid))
+        batch.deactivated[key] = reason
+        batch.new_users.discard(int(uid))
+        batch.restored.discard(int(uid))
+        batch.forget(key)
+        _shared.known_users.discard(int(uid))
+        _shared.inactive.add(key)
+    logger.info("Недоступные пользователи в архив: %s", len(items))
+
+
+def _archive_user_stats(stats: Dict[str, Any], reasons: Dict[str, str], now: int) -> None:
+    for uid, reason in reasons.items():
+        moved = {key: stats[key].pop(uid) for key in _USER_STATS_KEYS if uid in (stats.get(key) or {})}
+
+        def _put(archived, uid=uid, reason=reason, moved=moved):
+            archived.update({"user_id": int(uid), "reason": reason, "archived_at": now})
+            archived.setdefault("stats", {}).update(moved)
+
+        _update_archive(int(uid), _put)
+
+
+def _archive_user_file(user_id: int, deactivated_at: int) -> bool:
+    """
+    user_{id}.json -> архив (в потоке). False — файл менялся после отметки "недоступен"
+    (at округлено вниз до секунды, отсюда запас): пользователь успел вернуться.
+    """
+    user_file = db._get_user_file(user_id)
+    try:
+        if os.path.getmtime(user_file) > deactivated_at + 1:
+            return False
+    except FileNotFoundError:
+        return True
+    user_data = _load_json(user_file, None)
+
+    def _put(archived):
+        archived["user_id"] = user_id
+        archived["user_data"] = user_data
+
+    _update_archive(user_id, _put)
+    try:
+        os.remove(user_file)
+    except FileNotFoundError:
+        pass
+    return True
+
+
+async def _archive_own_users(items: Dict[str, int]) -> None:
+    """Архив user_{id}.json недоступных пользователей этого воркера: {user_id: at}."""
+    for uid, at in items.items():
+        try:
+            async with user_ordering.hold(int(uid)):
+                if uid not in _shared.inactive:
+                    continue  # вернулся, пока ждали его очередь
+                if _shared.batch.last_seen.get(uid, 0) > at + 1 or not await asyncio.to_thread(
+                    _archive_user_file, int(uid), at
+                ):
+                    # писал уже после отметки (воркер 0 не знал): возвращаем в рабочий набор
+                    track_user(int(uid))
+                    continue
+                _shared.archived.add(uid)
+        except Exception as e:
+            logger.warning("Не удалось заархивировать пользователя %s: %s", uid, e)
+
+
+def _restore_user_data(user_id: int) -> None:
+    archived = _load_json(_archive_path(user_id), None)
+    if archived and archived.get("user_data") and not os.path.exists(db._get_user_file(user_id)):
+        db.save_user_data(user_id, archived["user_data"])
+
+
+def _restore_user_stats(stats: Dict[str, Any], user_id: int) -> None:
+    uid = str(int(user_id))
+    with _file_lock(os.path.join(_data_dir(), "archive")):
+        archived = _load_json(_archive_path(user_id), None)
+        if not archived:
+            return
+        for key, value in (archived.get("stats") or {}).items():
+            stats.setdefault(key, {}).setdefault(uid, value)
+        try:
+            os.remove(_archive_path(user_id))
+        except FileNotFoundError:
+            pass
+
+
 # ---------- stats ----------
 def _stats_path() -> str:
     return os.path.join(_data_dir(), "stats.json")
@@ -177,52 +412,156 @@ def _load_stats() -> Dict[str, Any]:
     return _load_json(_stats_path(), _stats_default())
 
 
-def _save_stats(stats: Dict[str, Any]) -> None:
-    _save_json(_stats_path(), stats)
+def _add_counts(target: Dict[str, Any], delta: Dict[str, int]) -> None:
+    for key, n in delta.items():
+        target[key] = int(target.get(key, 0)) + n
 
 
 def mark_seen(user_id: int, username: str | None = None, first_name: str | None = None) -> None:
-    stats = _load_stats()
-
-    stats.setdefault("users_last_seen", {})
-    stats.setdefault("usernames", {})
-    stats.setdefault("first_names", {})
-
+    batch = _shared.batch
     uid = str(int(user_id))
-    stats["users_last_seen"][uid] = int(time.time())
-
+    batch.last_seen[uid] = int(time.time())
     if username:
-        stats["usernames"][uid] = username
+        batch.usernames[uid] = username
     if first_name:
-        stats["first_names"][uid] = first_name
-
-    _save_stats(stats)
+        batch.first_names[uid] = first_name
 
 
 def inc_message(user_id: int) -> None:
-    stats = _load_stats()
-
-    stats["messages_total"] = int(stats.get("messages_total", 0)) + 1
-
-    stats.setdefault("messages_by_user", {})
+    batch = _shared.batch
     uid = str(int(user_id))
-    stats["messages_by_user"][uid] = int(stats["messages_by_user"].get(uid, 0)) + 1
-
-    _save_stats(stats)
+    batch.messages_total += 1
+    batch.messages_by_user[uid] = batch.messages_by_user.get(uid, 0) + 1
 
 
 def inc_command(cmd: str) -> None:
-    stats = _load_stats()
-    stats.setdefault("commands", {})
-    stats["commands"][cmd] = int(stats["commands"].get(cmd, 0)) + 1
-    _save_stats(stats)
+    batch = _shared.batch
+    batch.commands[cmd] = batch.commands.get(cmd, 0) + 1
 
 
 def inc_author_selected(author_key: str) -> None:
-    stats = _load_stats()
-    stats.setdefault("authors_selected", {})
-    stats["authors_selected"][author_key] = int(stats["authors_selected"].get(author_key, 0)) + 1
-    _save_stats(stats)
+    batch = _shared.batch
+    batch.authors_selected[author_key] = batch.authors_selected.get(author_key, 0) + 1
+
+
+def _apply_batch(batch: _SharedBatch) -> tuple[Set[int], Dict[str, int]]:
+    """Слить пачку в файлы (в потоке). -> (users.json, {user_id: at} из inactive_users.json) после слива."""
+    reasons = batch.deactivated
+    restored = {str(u) for u in batch.restored}
+    known: Set[int] = set()
+
+    def _users(data):
+        users = set()
+        for x in data.get("users", []):
+            try:
+                users.add(int(x))
+            except Exception:
+                pass
+        before = len(users)
+        users |= batch.new_users
+        users -= {int(u) for u in reasons}
+        known.update(users)
+        if len(users) == before and not reasons:
+            return False
+        data["users"] = sorted(users)
+
+    inactive: Dict[str, int] = {}
+
+    def _inactive(data):
+        users = data.setdefault("users", {})
+        changed = False
+        for uid in restored:
+            changed = users.pop(uid, None) is not None or changed
+        for uid, reason in reasons.items():
+            users[uid] = {"reason": reason, "at": batch.deactivated_at}
+            changed = True
+        for uid, info in users.items():
+            inactive[uid] = int((info or {}).get("at") or 0)
+        return changed
+
+    def _stats(stats):
+        for key, bucket in (
+            ("users_last_seen", batch.last_seen),
+            ("usernames", batch.usernames),
+            ("first_names", batch.first_names),
+        ):
+            stats.setdefault(key, {}).update(bucket)
+        stats["messages_total"] = int(stats.get("messages_total", 0)) + batch.messages_total
+        _add_counts(stats.setdefault("messages_by_user", {}), batch.messages_by_user)
+        _add_counts(stats.setdefault("commands", {}), batch.commands)
+        _add_counts(stats.setdefault("authors_selected", {}), batch.authors_selected)
+        for uid in batch.restored:
+            _restore_user_stats(stats, uid)
+        if reasons:
+            _archive_user_stats(stats, reasons, batch.deactivated_at)
+
+    _update_json(_users_path(), {"users": []}, _users)
+    _update_json(_inactive_path(), {"users": {}}, _inactive)
+    if (batch.last_seen or batch.messages_total or batch.commands or batch.authors_selected
+            or batch.restored or reasons):
+        _update_json(_stats_path(), _stats_default(), _stats)
+    return known, inactive
+
+
+def _merge_view(known: Set[int], inactive: Set[str]) -> None:
+    # что лежит в файлах (в том числе от других воркеров) + то, что накопилось, пока шёл слив
+    batch = _shared.batch
+    _shared.known_users = (known | batch.new_users) - {int(u) for u in batch.deactivated}
+    _shared.inactive = (inactive - {str(u) for u in batch.new_users}) | set(batch.deactivated)
+
+
+async def flush_shared_state() -> None:
+    """Слить накопленное в users.json / stats.json и перечитать общий список пользователей."""
+    if _shared.lock is None:
+        _shared.lock = asyncio.Lock()
+    async with _shared.lock:
+        batch = _shared.take()
+        try:
+            known, inactive = await asyncio.to_thread(_apply_batch, batch)
+        except Exception:
+            # не потерять счётчики: вернуть пачку, следующий слив попробует снова
+            _shared.batch = _merge_batches(batch, _shared.batch)
+            raise
+        _merge_view(known, set(inactive))
+        index, workers = _shared.shard
+        own = {uid: at for uid, at in inactive.items()
+               if uid not in _shared.archived and shard_for(int(uid), workers) == index}
+    if own:
+        await _archive_own_users(own)
+
+
+def flush_shared_state_sync() -> None:
+    """Последний слив при остановке процесса (из обработчика сигнала, event loop уже не ждём)."""
+    try:
+        _apply_batch(_shared.take())
+    except Exception as e:
+        logger.warning("Не удалось сохранить статистику: %s", e)
+
+
+def _merge_batches(older: _SharedBatch, newer: _SharedBatch) -> _SharedBatch:
+    older.new_users |= newer.new_users
+    older.restored |= newer.restored
+    older.deactivated.update(newer.deactivated)
+    older.deactivated_at = max(older.deactivated_at, newer.deactivated_at)
+    older.last_seen.update(newer.last_seen)
+    older.usernames.update(newer.usernames)
+    older.first_names.update(newer.first_names)
+    older.messages_total += newer.messages_total
+    _add_counts(older.messages_by_user, newer.messages_by_user)
+    _add_counts(older.commands, newer.commands)
+    _add_counts(older.authors_selected, newer.authors_selected)
+    return older
+
+
+async def run_stats_flusher(interval: float = STATS_FLUSH_SECONDS) -> None:
+    # список пользователей читаем сразу, иначе первые апдейты все посчитаются новыми
+    await flush_shared_state()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_shared_state()
+        except Exception as e:
+            logger.warning("Не удалось сохранить статистику: %s", e)
 
 
 def _count_active(stats: Dict[str, Any], seconds: int) -> int:
@@ -260,9 +599,17 @@ def _safe_html(text: str) -> str:
     )
 
 
-def format_admin_stats() -> str:
-    users = get_all_users()
-    stats = _load_stats()
+def _admin_snapshot() -> tuple[list[int], Dict[str, Any], Dict[str, Any]]:
+    return get_all_users(), _load_stats(), get_inactive_users()
+
+
+async def admin_stats_text() -> str:
+    await flush_shared_state()
+    users, stats, inactive = await asyncio.to_thread(_admin_snapshot)
+    return format_admin_stats(users, stats, inactive)
+
+
+def format_admin_stats(users: list[int], stats: Dict[str, Any], inactive: Dict[str, Any]) -> str:
 
     active_24h = _count_active(stats, 24 * 3600)
     active_7d = _count_active(stats, 7 * 24 * 3600)
@@ -275,6 +622,8 @@ def format_admin_stats() -> str:
     lines = []
     lines.append("📊 <b>Статистика бота</b>\n")
     lines.append(f"👥 Пользователей всего: <b>{len(users)}</b>")
+    if inactive:
+        lines.append(f"🚫 Недоступны (заблокировали бота / удалены): <b>{len(inactive)}</b>")
     lines.append(f"🟢 Активные за 24ч: <b>{active_24h}</b>")
     lines.append(f"🟡 Активные за 7д: <b>{active_7d}</b>")
     lines.append(f"🔵 Активные за 30д: <b>{active_30d}</b>")
@@ -307,6 +656,18 @@ def format_admin_stats() -> str:
         for k, cnt in top_cmds:
             lines.append(f"• <code>{k}</code>: <b>{cnt}</b>")
 
+    up = upstream_limiter.metrics()
+    lines.append("\n🧠 <b>Нагрузка на модель</b>")
+    lines.append(f"• Лимит одновременных запросов: <b>{up['limit']}</b> (сейчас {up['inflight']}, в очереди {up['queued']})")
+    lines.append(f"• Отказов за {int(up['window_s'] // 60)} мин: <b>{up['rejection_rate'] * 100:.1f}%</b>")
+    if up["overloads"]:
+        lines.append("• Перегрузки: " + ", ".join(f"{k} — {v}" for k, v in sorted(up["overloads"].items())))
+
+    uq = user_ordering.metrics()
+    lines.append("\n📥 <b>Очереди пользователей</b>")
+    lines.append(f"• Сейчас обрабатываются: <b>{uq['users_in_flight']}</b>, ждут: <b>{uq['queued_updates']}</b> (макс. глубина {uq['max_depth']}, пик {uq['peak_depth']})")
+    lines.append(f"• Ожидание в очереди: p50 {uq['wait_p50_ms']} мс, p99 {uq['wait_p99_ms']} мс; отброшено: {uq['dropped_total']}, не дождались: {uq['timed_out_total']}")
+
     return "\n".join(lines)
 
 
@@ -343,7 +704,7 @@ async def cb_admin_stats(callback: CallbackQuery):
         return
 
     await callback.answer()
-    await callback.message.answer(format_admin_stats(), parse_mode=ParseMode.HTML)
+    await callback.message.answer(await admin_stats_text(), parse_mode=ParseMode.HTML)
 
 
 @router.callback_query(F.data == "admin_broadcast_help")
@@ -394,6 +755,8 @@ async def cmd_admin(message: Message):
         "🛠 <b>Админ-панель</b>\n\n"
         "• <code>/stats</code> — статистика\n"
         "• <code>/broadcast ТЕКСТ</code> — рассылка\n"
+        "• <code>/broadcast_cancel ID</code> — остановить рассылку\n"
+        "• <code>/reload_kb</code> — перечитать базу знаний\n"
         "• <code>/whoami</code> — ваш ID\n",
         parse_mode=ParseMode.HTML,
         reply_markup=get_admin_keyboard(),
@@ -411,7 +774,11 @@ async def cmd_stats(message: Message):
         await message.answer("⛔ Нет доступа.")
         return
 
-    await message.answer(format_admin_stats(), parse_mode=ParseMode.HTML)
+    await message.answer(await admin_stats_text(), parse_mode=ParseMode.HTML)
+
+
+# при BOT_WORKERS > 1 приёмник отправляет эти команды в воркер 0 — там живут все рассылки
+BROADCAST_COMMANDS = ("/broadcast", "/broadcast_cancel")
 
 
 @router.message(Command("broadcast"))
@@ -430,47 +797,117 @@ async def cmd_broadcast(message: Message):
         await message.answer("Использование: <code>/broadcast ТЕКСТ</code>", parse_mode=ParseMode.HTML)
         return
 
-    users = get_all_users()
-    ok = 0
-    fail = 0
-
-    await message.answer(
-        f"📣 Начинаю рассылку… Пользователей: <b>{len(users)}</b>",
-        parse_mode=ParseMode.HTML,
+    # новые пользователи за последние секунды ещё в памяти — сначала сливаем
+    await flush_shared_state()
+    job = await broadcasts.start(
+        message.bot,
+        f"📣 <b>Сообщение от администратора</b>\n\n{payload}",
+        await asyncio.to_thread(get_all_users),
+        admin_chat_id=message.chat.id,
     )
+    logger.info("Рассылка %s запущена: %s получателей", job.job_id, len(job.users))
 
-    for uid in users:
-        try:
-            await message.bot.send_message(
-                uid,
-                f"📣 <b>Сообщение от администратора</b>\n\n{payload}",
-                parse_mode=ParseMode.HTML,
-            )
-            ok += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            fail += 1
 
+@router.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: Message):
+    user_id = message.from_user.id
+    track_user(user_id)
+    inc_command("/broadcast_cancel")
+
+    if not is_admin(user_id):
+        await message.answer("⛔ Нет доступа.")
+        return
+
+    parts = (message.text or "").split()
+    running = broadcasts.running()
+    if len(parts) < 2:
+        if not running:
+            await message.answer("Сейчас рассылок нет.")
+            return
+        ids = ", ".join(f"<code>{j.job_id}</code>" for j in running)
+        await message.answer(
+            f"Идут рассылки: {ids}\n\nОстановить: <code>/broadcast_cancel ID</code>",
+            parse_mode=ParseMode.HTML,
+        )
+        return
+
+    if broadcasts.cancel(parts[1]):
+        await message.answer(f"⛔ Останавливаю рассылку <code>{parts[1]}</code>…", parse_mode=ParseMode.HTML)
+    else:
+        await message.answer("Такой идущей рассылки нет.")
+
+
+@router.message(Command("reload_kb"))
+async def cmd_reload_kb(message: Message):
+    user_id = message.from_user.id
+    track_user(user_id)
+    mark_seen(user_id, message.from_user.username, message.from_user.first_name)
+    inc_command("/reload_kb")
+
+    if not is_admin(user_id):
+        await message.answer("⛔ Нет доступа.")
+        return
+
+    # индекс собирается в отдельном потоке, бот продолжает отвечать
+    reloaded = await asyncio.to_thread(reload_kb, True)
     await message.answer(
-        "✅ <b>Рассылка завершена</b>\n\n"
-        f"Отправлено: <b>{ok}</b>\n"
-        f"Не доставлено: <b>{fail}</b>",
+        "📚 <b>База знаний перезагружена</b>\n\n"
+        f"Авторов перечитано: <b>{len(reloaded)}</b>",
         parse_mode=ParseMode.HTML,
     )
 
 
+# =========================
+# 📚 Горячая перезагрузка базы знаний (по изменению файлов)
+# =========================
+KB_WATCH_SECONDS = int(os.getenv("KB_WATCH_SECONDS", "30"))  # 0 — не следить
+# "Горячие" авторы через запятую: их индексы строятся при старте (в каждом воркере).
+# Пусто — все лениво, при первом вопросе по автору (в фоновом потоке, см. GigaChatClient)
+KB_PREWARM_AUTHORS = [a.strip() for a in os.getenv("KB_PREWARM_AUTHORS", "").split(",") if a.strip()]
+
+
+async def prewarm_kb_async(author_keys: List[str]) -> None:
+    try:
+        loaded = await asyncio.to_thread(prewarm_kb, author_keys)
+        logger.info("📚 Индексы загружены заранее: %s из %s", loaded, len(author_keys))
+    except Exception as e:
+        logger.warning("Не удалось загрузить базу знаний заранее: %s", e)
+
+
+async def watch_kb(interval: int) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reloaded = await asyncio.to_thread(reload_kb)
+            if reloaded:
+                logger.info("📚 База знаний обновлена: %s", ", ".join(reloaded))
+        except Exception as e:
+            logger.warning("Не удалось перезагрузить базу знаний: %s", e)
+
+
 # =========================
 # 🌐 Мини-сервер для Render/Railway
 # =========================
-async def start_web_server() -> None:
+def _process_metrics() -> Dict[str, Any]:
+    return {"upstream": upstream_limiter.metrics(), "user_queues": user_ordering.metrics()}
+
+
+def build_web_app(metrics_fn=_process_metrics) -> web.Application:
     async def health(_request: web.Request) -> web.Response:
         return web.Response(text="OK")
 
+    async def metrics(_request: web.Request) -> web.Response:
+        return web.json_response(metrics_fn())
+
     app = web.Application()
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    return app
 
-    runner = web.AppRunner(app)
+
+async def start_web_server(app: Optional[web.Application] = None) -> web.AppRunner:
+    runner = web.AppRunner(app or build_web_app())
     await runner.setup()
 
     port = int(os.getenv("PORT", "10000"))
@@ -478,6 +915,67 @@ async def start_web_server() -> None:
     await site.start()
 
     logger.info("🌐 Web server started on 0.0.0.0:%s", port)
+    return runner
+
+
+def webhook_secret() -> str:
+    """Секрет вебхука: из WEBHOOK_SECRET или детерминированно из токена (A-Z, a-z, 0-9 — как требует Telegram)."""
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode("utf-8")).hexdigest()
+
+
+# =========================
+# 🧠 Rolling summary диалога (в фоне, вне ответа пользователю)
+# =========================
+SUMMARY_BATCH_MESSAGES = 4
+_summary_in_progress: Set[tuple] = set()
+_summary_tasks: Set[asyncio.Task] = set()
+
+
+def build_prompt_history(user_data: Dict[str, Any], author_key: str) -> list[dict]:
+    """
+    История для промпта: несвёрнутые в summary сообщения + последний обмен репликами с этим автором.
+    """
+    history = user_data.get("conversation_history", []) or []
+    if not ROLLING_SUMMARY:
+        return history
+
+    own = [m for m in history if (m.get("author") or author_key) == author_key]
+    pending = (user_data.get("summary_pending") or {}).get(author_key) or []
+    return list(pending) + own[-RECENT_WINDOW_MESSAGES:]
+
+
+def get_prompt_summary(user_data: Dict[str, Any], author_key: str) -> str:
+    if not ROLLING_SUMMARY:
+        return ""
+    item = (user_data.get("summaries") or {}).get(author_key) or {}
+    return item.get("text", "")
+
+
+async def _summarize_in_background(user_id: int, author_key: str) -> None:
+    key = (user_id, author_key)
+    try:
+        pending = db.get_pending_for_summary(user_id, author_key)
+        if len(pending) < SUMMARY_BATCH_MESSAGES:
+            return
+        previous = db.get_summary(user_id, author_key)
+        summary = await gigachat_client.summarize_history(previous, pending)
+        db.save_summary(user_id, author_key, summary, consumed=len(pending))
+    except Exception as e:
+        logger.warning("Не удалось обновить summary (%s, %s): %s", user_id, author_key, e)
+    finally:
+        _summary_in_progress.discard(key)
+
+
+def schedule_summary(user_id: int, author_key: str) -> None:
+    if not ROLLING_SUMMARY:
+        return
+    key = (user_id, author_key)
+    if key in _summary_in_progress:
+        return
+    _summary_in_progress.add(key)
+    task = asyncio.create_task(_summarize_in_background(user_id, author_key))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
 
 
 # =========================
@@ -788,6 +1286,139 @@ async def cb_author_selected(callback: CallbackQuery):
     await callback.answer("Выбран")
 
 
+async def reply_as_author(
+    message: Message,
+    user_id: int,
+    author_key: str,
+    user_text: str,
+    user_data: Dict[str, Any] | None = None,
+) -> None:
+    """
+    Обычный ответ автора на вопрос: "обдумывает…" -> ответ -> история и summary.
+    message — куда отвечать (сообщение пользователя или сообщение бота с кнопками).
+    """
+    if user_data is None:
+        user_data = db.get_user_data(user_id)
+    author = get_author(author_key)
+
+    thinking = await message.answer(
+        f"<i>✨ {author.get('name', author_key)} обдумывает ответ...</i>",
+        parse_mode=ParseMode.HTML,
+    )
+
+    try:
+        response = await gigachat_client.generate_response(
+            author_key=author_key,
+            user_message=user_text,
+            conversation_history=build_prompt_history(user_data, author_key),
+            summary=get_prompt_summary(user_data, author_key),
+        )
+        try:
+            await thinking.delete()
+        except Exception:
+            pass
+
+        await message.answer(
+            f"{author.get('name', author_key)}\n\n{response}",
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_chat_keyboard(),
+        )
+        db.update_conversation(user_id, author_key, user_text, response)
+        schedule_summary(user_id, author_key)
+
+    except Exception as e:
+        logger.exception("Ошибка: %s", e)
+        try:
+            await thinking.delete()
+        except Exception:
+            pass
+        await message.answer(
+            "⚠️ <b>Произошла ошибка.</b>\nПопробуйте ещё раз или нажмите /start",
+            parse_mode=ParseMode.HTML,
+        )
+
+
+@router.callback_query(F.data.startswith("quick_author_"))
+async def cb_quick_author(callback: CallbackQuery):
+    """
+    Кнопка "Ответить как …" из автоподсказки: выбираем автора и сразу отвечаем
+    на вопрос, который пользователь задал до выбора.
+    """
+    user_id = callback.from_user.id
+    track_user(user_id)
+    mark_seen(user_id, callback.from_user.username, callback.from_user.first_name)
+
+    author_key = callback.data[len("quick_author_"):]
+    if author_key not in list_author_keys():
+        await callback.answer("Автор не найден", show_alert=True)
+        return
+
+    user_data = db.get_user_data(user_id)
+    user_data["selected_author"] = author_key
+    user_data["mode"] = None
+    user_data["compare_first_author"] = None
+    db.save_user_data(user_id, user_data)
+    inc_author_selected(author_key)
+
+    question = db.pop_pending_question(user_id)
+    author = get_author(author_key)
+
+    if not question:
+        await callback.message.edit_text(
+            f"{author.get('name', author_key)}\n\n"
+            f"💬 {author.get('greeting', 'Здравствуйте!')}\n\n"
+            "<i>Задавайте вопросы — отвечу в своём стиле!</i>",
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_chat_keyboard(),
+        )
+        await callback.answer("Выбран")
+        return
+
+    await callback.answer("Выбран")
+    # кнопки подсказки больше не нужны — оставляем сам вопрос с выбранным автором
+    try:
+        await callback.message.edit_text(
+            f"✅ Отвечает: <b>{_safe_html(author.get('name', author_key))}</b>",
+            parse_mode=ParseMode.HTML,
+        )
+    except Exception:
+        pass
+
+    await reply_as_author(callback.message, user_id, author_key, question, db.get_user_data(user_id))
+
+
+async def _routing_state(user_id: int):
+    """(mode, selected_author, отложенный вопрос) из памяти db; файл — только при первом апдейте."""
+    state = db.routing_state(user_id)
+    if state is None:
+        await asyncio.to_thread(db.get_user_data, user_id)
+        state = db.routing_state(user_id) or (None, None, "")
+    return state
+
+
+async def upstream_mode(user_id: int):
+    """Куда уйдёт следующее сообщение пользователя — для оценки нагрузки в антифлуде."""
+    mode, selected_author, _pending = await _routing_state(user_id)
+    if mode in ("compare_first", "compare_second") or not selected_author:
+        return None
+    if mode in ("cowrite_prose", "cowrite_poem"):
+        return "cowrite"
+    return "chat"
+
+
+async def callback_cost(user_id: int, data: str) -> float:
+    """
+    Стоимость нажатия для антифлуда: навигация и настройки бесплатны (считаются только
+    как действие), кнопки, за которыми идёт запрос к модели, — как сам запрос.
+    """
+    if data.startswith("quick_author_"):
+        pending = (await _routing_state(user_id))[2]
+        return estimate_cost(pending, "chat", GIGACHAT_MODEL) if pending else 0.0
+    if data.startswith("author_") and (await _routing_state(user_id))[0] == "compare_second":
+        return estimate_cost("", "compare", GIGACHAT_MODEL)
+    return 0.0
+
+
 @router.message(F.text)
 async def handle_message(message: Message):
     user_id = message.from_user.id
@@ -812,6 +1443,19 @@ async def handle_message(message: Message):
 
     author_key = user_data.get("selected_author")
     if not author_key:
+        # автор не выбран: пробуем угадать его по тексту и предлагаем ответить сразу
+        candidates = guess_authors_from_text(user_text)
+        if candidates:
+            db.set_pending_question(user_id, user_text)
+            names = ", ".join(f"<b>{_safe_html(c['author_name'])}</b>" for c in candidates)
+            await message.answer(
+                f"🔎 Похоже, речь о: {names}.\n\n"
+                "Выберите, кто ответит на вопрос, — отвечу сразу:",
+                parse_mode=ParseMode.HTML,
+                reply_markup=build_quick_author_keyboard(candidates),
+            )
+            return
+
         await message.answer(
             "❌ <b>Сначала выберите автора!</b>\n\n👇 Выберите эпоху:",
             parse_mode=ParseMode.HTML,
@@ -858,6 +1502,7 @@ async def handle_message(message: Message):
                 reply_markup=get_chat_keyboard(),
             )
             db.update_conversation(user_id, author_key, user_text, response)
+            schedule_summary(user_id, author_key)
             return
 
         except Exception as e:
@@ -874,65 +1519,124 @@ async def handle_message(message: Message):
             return
 
     # Обычный чат
-    thinking = await message.answer(
-        f"<i>✨ {author.get('name', author_key)} обдумывает ответ...</i>",
-        parse_mode=ParseMode.HTML,
-    )
+    await reply_as_author(message, user_id, author_key, user_text, user_data)
 
-    try:
-        response = await gigachat_client.generate_response(
-            author_key=author_key,
-            user_message=user_text,
-            conversation_history=user_data.get("conversation_history", []),
-        )
-        try:
-            await thinking.delete()
-        except Exception:
-            pass
 
-        await message.answer(
-            f"{author.get('name', author_key)}\n\n{response}",
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_chat_keyboard(),
-        )
-        db.update_conversation(user_id, author_key, user_text, response)
+# =========================
+# 🚀 Запуск
+# =========================
+def build_dispatcher():
+    """Dispatcher со всеми middleware и хендлерами -> (dp, антифлуд-лимитер)."""
+    dp = Dispatcher()
+    limiter = build_rate_limiter(
+        RateLimitConfig(),
+        RATE_LIMIT_BACKEND,
+        path=RATE_LIMIT_SQLITE_PATH,
+        url=RATE_LIMIT_REDIS_URL,
+    )
+    logger.info("Антифлуд: %s", type(limiter).__name__)
+    dp.message.middleware(AntiFloodMiddleware(limiter, upstream_mode, GIGACHAT_MODEL))
+    dp.callback_query.middleware(CallbackFloodMiddleware(limiter, callback_cost))
+    # апдейты одного пользователя — строго по очереди (один user_{id}.json), разных — параллельно;
+    # после антифлуда: лимит и повторные нажатия отсекаются до очереди
+    dp.message.middleware(user_ordering)
+    dp.callback_query.middleware(user_ordering)
 
-    except Exception as e:
-        logger.exception("Ошибка: %s", e)
-        try:
-            await thinking.delete()
-        except Exception:
-            pass
-        await message.answer(
-            "⚠️ <b>Произошла ошибка.</b>\nПопробуйте ещё раз или нажмите /start",
-            parse_mode=ParseMode.HTML,
-        )
+    dp.include_router(router)
+    logger.info("Клавиатур собрано заранее: %s", prebuild_keyboards())
+    return dp, limiter
+
+
+async def register_webhook(bot: Bot) -> None:
+    # апдейты, пришедшие за время рестарта, Telegram держит у себя и дошлёт сам
+    await bot.set_webhook(
+        url=WEBHOOK_BASE_URL + WEBHOOK_PATH,
+        secret_token=webhook_secret(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=router.resolve_used_update_types(),
+        drop_pending_updates=DROP_PENDING_UPDATES,
+    )
+    logger.info("🤖 Webhook: %s%s (max_connections=%s)", WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_MAX_CONNECTIONS)
 
 
 # =========================
-# 🌐 Мини-сервер для Render/Railway
+# 🧩 Несколько процессов (BOT_WORKERS > 1)
 # =========================
-async def start_web_server() -> None:
-    async def health(_request: web.Request) -> web.Response:
-        return web.Response(text="OK")
-
-    app = web.Application()
-    app.router.add_get("/", health)
-    app.router.add_get("/health", health)
+def _shard_worker(index: int, workers: int, updates) -> None:
+    """Точка входа процесса-воркера (spawn)."""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_run_shard(index, workers, updates))
+    except KeyboardInterrupt:
+        pass
 
-    runner = web.AppRunner(app)
-    await runner.setup()
 
-    port = int(os.getenv("PORT", "10000"))
-    site = web.TCPSite(runner, host="0.0.0.0", port=port)
-    await site.start()
+async def _run_shard(index: int, workers: int, updates) -> None:
+    bot = Bot(token=BOT_TOKEN)
+    dp, limiter = build_dispatcher()
+
+    # лимит одновременных запросов к модели — общий бюджет, делим между воркерами
+    cfg = upstream_limiter.cfg
+    cfg.max_limit = max(cfg.min_limit, cfg.max_limit / workers)
+    upstream_limiter.limit = max(cfg.min_limit, min(upstream_limiter.limit, cfg.max_limit))
+
+    _shared.shard = (index, workers)
+    limiter_sweeper = asyncio.create_task(limiter.run_sweeper())
+    stats_flusher = asyncio.create_task(run_stats_flusher())
+    broadcasts.on_unreachable = deactivate_users
+    if index == 0:
+        broadcasts.resume_all(bot)
+    kb_prewarm = None
+    if KB_PREWARM_AUTHORS:
+        kb_prewarm = asyncio.create_task(prewarm_kb_async(KB_PREWARM_AUTHORS))
+    kb_watcher = None
+    if KB_WATCH_SECONDS > 0:
+        kb_watcher = asyncio.create_task(watch_kb(KB_WATCH_SECONDS))
+
+    logger.info("🧩 Воркер %s/%s запущен (pid %s)", index, workers, os.getpid())
+    try:
+        await consume(updates, lambda update: dp.feed_raw_update(bot, update))
+    finally:
+        limiter_sweeper.cancel()
+        broadcasts.shutdown()
+        if kb_prewarm is not None:
+            kb_prewarm.cancel()
+        if kb_watcher is not None:
+            kb_watcher.cancel()
+        await bot.session.close()
+        stats_flusher.cancel()
+        await flush_shared_state()
+
+
+async def run_sharded() -> None:
+    """Приёмник: getUpdates / вебхук -> воркер по user_id, сам хендлеры не выполняет."""
+    queues, procs = start_workers(_shard_worker, BOT_WORKERS)
+    # рассылки запускаются, продолжаются и останавливаются в одном воркере
+    shard_router = ShardRouter(queues, pinned_commands=BROADCAST_COMMANDS)
+
+    app = build_web_app(lambda: {"shards": shard_router.metrics()})
+    if WEBHOOK_BASE_URL:
+        add_webhook_route(app, WEBHOOK_PATH, webhook_secret(), shard_router)
+    runner = await start_web_server(app)
 
-    logger.info("🌐 Web server started on 0.0.0.0:%s", port)
+    bot = Bot(token=BOT_TOKEN)
+    try:
+        if WEBHOOK_BASE_URL:
+            await register_webhook(bot)
+            await asyncio.Event().wait()
+        else:
+            try:
+                await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            except Exception:
+                pass
+            logger.info("🤖 Start polling, воркеров: %s", BOT_WORKERS)
+            await poll_updates(BOT_TOKEN, shard_router, router.resolve_used_update_types())
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+        await asyncio.to_thread(stop_workers, queues, procs)
 
 
-# =========================
-# 🚀 Запуск
-# =========================
 async def main():
     if not BOT_TOKEN:
         raise RuntimeError("❌ BOT_TOKEN пуст. Добавь BOT_TOKEN в переменные окружения / .env")
@@ -952,29 +1656,60 @@ async def main():
     for _sig in (getattr(signal, "SIGTERM", None), getattr(signal, "SIGINT", None)):
         if _sig is not None:
             try:
-                signal.signal(_sig, lambda *_: (_cleanup(), os._exit(0)))
+                signal.signal(_sig, lambda *_: (flush_shared_state_sync(), _cleanup(), os._exit(0)))
             except Exception:
                 pass
 
-    await start_web_server()
+    if BOT_WORKERS > 1:
+        try:
+            await run_sharded()
+        finally:
+            _cleanup()
+        return
 
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-
-    limiter = InMemoryRateLimiter(RateLimitConfig())
-    dp.message.middleware(AntiFloodMiddleware(limiter))
-
-    dp.include_router(router)
+    dp, limiter = build_dispatcher()
+
+    # вебхук живёт на том же веб-сервере, что и /health: маршрут надо добавить до старта
+    app = build_web_app()
+    if WEBHOOK_BASE_URL:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=webhook_secret()).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    runner = await start_web_server(app)
+
+    limiter_sweeper = asyncio.create_task(limiter.run_sweeper())
+    stats_flusher = asyncio.create_task(run_stats_flusher())
+    broadcasts.on_unreachable = deactivate_users
+    broadcasts.resume_all(bot)
+    kb_prewarm = None
+    if KB_PREWARM_AUTHORS:
+        kb_prewarm = asyncio.create_task(prewarm_kb_async(KB_PREWARM_AUTHORS))
+    kb_watcher = None
+    if KB_WATCH_SECONDS > 0:
+        kb_watcher = asyncio.create_task(watch_kb(KB_WATCH_SECONDS))
 
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-    except Exception:
-        pass
+        if WEBHOOK_BASE_URL:
+            await register_webhook(bot)
+            await asyncio.Event().wait()
+        else:
+            try:
+                await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            except Exception:
+                pass
 
-    logger.info("🤖 Start polling...")
-    try:
-        await dp.start_polling(bot)
+            logger.info("🤖 Start polling...")
+            await dp.start_polling(bot)
     finally:
+        limiter_sweeper.cancel()
+        broadcasts.shutdown()
+        if kb_prewarm is not None:
+            kb_prewarm.cancel()
+        if kb_watcher is not None:
+            kb_watcher.cancel()
+        await runner.cleanup()
+        stats_flusher.cancel()
+        await flush_shared_state()
         _cleanup()
 
 
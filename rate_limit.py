@@ -1,95 +1,603 @@
+import abc
+import asyncio
+from array import array
+import inspect
+import logging
+import os
+import sqlite3
+import threading
 import time
-from collections import deque
 from dataclasses import dataclass
-from typing import Deque, Dict, Optional
+from typing import Callable, Dict, Optional, Tuple
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 
 
 @dataclass
 class RateLimitConfig:
+    # скользящее окно: в любые per_seconds — не больше max_messages сообщений
     max_messages: int = 6
     per_seconds: int = 10
     cooldown_seconds: int = 12
-    max_ai_messages: int = 3
-    ai_per_seconds: int = 20
+    # бюджет нагрузки на модель: сколько оценочных токенов (запрос + ответ) за cost_per_seconds
+    max_cost_tokens: int = 8000
+    cost_per_seconds: int = 30
+    sweep_seconds: int = 60       # как часто выкидывать записи простаивающих пользователей
+    sweep_chunk: int = 20000      # сколько записей проверять за один шаг, не блокируя event loop
+    lease_tokens: int = 2         # общий лимитер: сколько сообщений "про запас" брать в локальный кэш
+    lease_cost_tokens: int = 3000 # ...и сколько бюджета нагрузки вместе с ними
+    duplicate_click_seconds: float = 1.5  # повторное нажатие той же кнопки в этом окне — игнор
 
 
-class InMemoryRateLimiter:
-    def __init__(self, cfg: RateLimitConfig):
+# =========================
+# Оценка стоимости запроса к модели
+# =========================
+# Грубо, но монотонно: чем длиннее текст и "тяжелее" режим, тем дороже.
+# Постоянная часть промпта (стиль, правила, СПРАВКА, summary) одинакова у всех сообщений
+# режима и уже ограничена счётчиком сообщений; в бюджет идёт то, что растёт с запросом, —
+# текст пользователя и ответ. Иначе постоянная часть перевешивала, и короткие сообщения
+# упирались в бюджет раньше, чем в прежний лимит: самое короткое сообщение базовой модели
+# стоит не больше доли бюджета на одно сообщение (max_cost_tokens / сообщений за cost_per_seconds).
+CHARS_PER_TOKEN = 3.5
+
+# Промпт сверх обычного: у сравнения — вторая СПРАВКА (до 2200 симв.)
+EXTRA_PROMPT_TOKENS = {"chat": 0, "cowrite": 0, "compare": 630}
+
+# Ожидаемый размер ответа базовой модели по режиму
+EXPECTED_OUTPUT_TOKENS = {"chat": 350, "cowrite": 500, "compare": 800}
+
+# Старшие модели отвечают длиннее и обходятся апстриму дороже
+MODEL_TIER_OUTPUT_FACTOR = {"GigaChat": 1.0, "GigaChat-Plus": 1.2, "GigaChat-Pro": 1.5, "GigaChat-Max": 2.0}
+
+
+def estimate_cost(text: str, mode: Optional[str], model: str = "GigaChat:latest") -> float:
+    """
+    Оценка нагрузки на модель в токенах (текст запроса + ожидаемый ответ).
+    mode: chat | cowrite | compare; None — сообщение до модели не дойдёт, стоимость 0.
+    """
+    if mode not in EXTRA_PROMPT_TOKENS:
+        return 0.0
+    tier = MODEL_TIER_OUTPUT_FACTOR.get((model or "").split(":")[0], 1.0)
+    prompt = EXTRA_PROMPT_TOKENS[mode] + len(text or "") / CHARS_PER_TOKEN
+    return prompt + EXPECTED_OUTPUT_TOKENS[mode] * tier
+
+
+# запас на накопленную ошибку float: запрос ровно во весь свободный бюджет должен проходить
+_EPS = 1e-6
+
+
+class _UserState:
+    """
+    Состояние пользователя фиксированного размера вместо растущей очереди меток времени:
+    - stamps — кольцо из max_messages последних принятых сообщений, head — самое старое;
+      если и оно моложе per_seconds, окно заполнено;
+    - tat_cost — GCRA бюджета нагрузки ("theoretical arrival time"): когда бюджет
+      снова станет полностью свободным.
+    """
+    __slots__ = ("stamps", "head", "tat_cost", "cooldown_until")
+
+    def __init__(self, empty_ring: array):
+        self.stamps = empty_ring[:]
+        self.head = 0
+        self.tat_cost = 0.0
+        self.cooldown_until = 0.0
+
+
+class _Limits:
+    """Параметры окна сообщений и GCRA бюджета нагрузки, общие для всех лимитеров."""
+
+    def __init__(self, cfg: "RateLimitConfig"):
         self.cfg = cfg
-        self._bucket: Dict[int, Deque[float]] = {}
-        self._bucket_ai: Dict[int, Deque[float]] = {}
-        self._cooldown_until: Dict[int, float] = {}
+        # окно сообщений; пустое кольцо — метки "давно", все места свободны
+        self._window = float(cfg.per_seconds)
+        self._size = max(1, cfg.max_messages)
+        self._empty_ring = array("d", [float("-inf")] * self._size)
+        # бюджет нагрузки: секунд на токен, окно — cost_per_seconds
+        self._interval_cost = cfg.cost_per_seconds / max(1, cfg.max_cost_tokens)
+        self._cost_window = float(cfg.cost_per_seconds)
+
+    def _clamp_cost(self, cost: float) -> float:
+        # запрос дороже всего бюджета иначе не прошёл бы никогда — считаем его "во весь бюджет"
+        return min(max(0.0, float(cost or 0.0)), float(self.cfg.max_cost_tokens))
+
+
+class InMemoryRateLimiter(_Limits):
+    """
+    - сообщения: скользящее окно, как у прежнего лимитера, — в любые per_seconds не больше
+      max_messages, превысил — cooldown. Хранятся только max_messages последних меток
+      (кольцо фиксированного размера), а не очередь на пользователя;
+    - нагрузка на модель: GCRA (generic cell rate algorithm) — каждое сообщение списывает
+      свою стоимость (estimate_cost) из бюджета max_cost_tokens за cost_per_seconds;
+      не хватает — ждать ровно столько, сколько нужно, чтобы бюджет восстановился.
+      Тяжёлые запросы ждут пропорционально.
+    Проверка — O(1) по времени и памяти, сколько бы сообщений ни было в окне.
+    Записи, которые вернулись в "пустое" состояние, удаляет sweep() / run_sweeper().
+    """
+
+    def __init__(self, cfg: RateLimitConfig):
+        super().__init__(cfg)
+        self._state: Dict[int, _UserState] = {}
+
+    def _now(self) -> float:
+        return time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def check(self, user_id: int, cost: float = 0.0) -> Optional[int]:
+        """None — можно; иначе сколько секунд подождать. cost — оценка токенов (estimate_cost)."""
+        now = self._now()
+
+        st = self._state.get(user_id)
+        if st is None:
+            st = self._state[user_id] = _UserState(self._empty_ring)
+
+        if now < st.cooldown_until:
+            return int(st.cooldown_until - now) + 1
+
+        # max_messages-е с конца сообщение ещё в окне — окно заполнено
+        if now - st.stamps[st.head] <= self._window:
+            st.cooldown_until = now + self.cfg.cooldown_seconds
+            return self.cfg.cooldown_seconds
+
+        cost = self._clamp_cost(cost)
+        if cost:
+            tat_cost = max(st.tat_cost, now) + cost * self._interval_cost
+            over = tat_cost - now - self._cost_window
+            if over > _EPS:
+                return int(over) + 1
+            st.tat_cost = tat_cost
+
+        st.stamps[st.head] = now
+        st.head = (st.head + 1) % self._size
+        return None
+
+    # ---------- очистка простаивающих ----------
+
+    def _idle(self, st: _UserState, now: float) -> bool:
+        # всё в прошлом — запись ничем не отличается от новой, её можно забыть
+        return (now - st.stamps[st.head - 1] > self._window
+                and st.tat_cost <= now and st.cooldown_until <= now)
+
+    def sweep(self) -> int:
+        """Удаляет записи простаивающих пользователей за один проход. Возвращает сколько удалено."""
+        now = self._now()
+        idle = [uid for uid, st in self._state.items() if self._idle(st, now)]
+        for uid in idle:
+            del self._state[uid]
+        return len(idle)
+
+    async def run_sweeper(self) -> None:
+        """
+        Фоновая очистка: раз в sweep_seconds проходит по снимку ключей кусками
+        по sweep_chunk, отдавая управление event loop между кусками.
+        """
+        while True:
+            await asyncio.sleep(self.cfg.sweep_seconds)
+            keys = list(self._state)
+            for i in range(0, len(keys), self.cfg.sweep_chunk):
+                now = self._now()
+                for uid in keys[i:i + self.cfg.sweep_chunk]:
+                    st = self._state.get(uid)
+                    if st is not None and self._idle(st, now):
+                        del self._state[uid]
+                await asyncio.sleep(0)
+
+
+# =========================
+# Общее состояние для нескольких инстансов бота
+# =========================
+class SharedRateLimiter(_Limits, abc.ABC):
+    """
+    База для лимитеров с общим хранилищем (SQLite, Redis): то же окно и тот же бюджет,
+    но проверка и запись — одна атомарная операция в хранилище, поэтому лимит держится
+    между процессами и хостами. Время — общее (time.time() / TIME сервера).
+
+    Быстрый путь без хранилища:
+    - пользователь явно под лимитом: хранилище вместе с текущим сообщением выдаёт
+      до lease_tokens сообщений и до lease_cost_tokens бюджета "про запас" (только если
+      после этого у него остаётся хотя бы одно сообщение и половина бюджета), и следующие
+      сообщения, пока запаса хватает, списываются локально;
+    - пользователь в cooldown: отказ локально до конца cooldown.
+    Запас живёт не дольше окна per_seconds. В окне хранилища он отмечен моментом выдачи,
+    а тратится позже, поэтому на стыке окон проходит до lease_tokens сообщений сверх
+    max_messages; lease_tokens=0 — окно точное, но каждое сообщение идёт в хранилище.
+    """
+
+    def __init__(self, cfg: RateLimitConfig):
+        super().__init__(cfg)
+        self._local: Dict[int, _Lease] = {}
+        # на случай недоступного хранилища
+        self._fallback = InMemoryRateLimiter(cfg)
 
     def _now(self) -> float:
         return time.time()
 
-    def _get_deque(self, store: Dict[int, Deque[float]], user_id: int) -> Deque[float]:
-        if user_id not in store:
-            store[user_id] = deque()
-        return store[user_id]
+    @abc.abstractmethod
+    async def _reserve(self, user_id: int, cost: float) -> Tuple[Optional[int], int, float]:
+        """
+        Атомарно: проверить и списать сообщение стоимостью cost + запас.
+        -> (ждать сек | None, сообщений про запас, бюджета про запас)
+        """
+
+    async def check(self, user_id: int, cost: float = 0.0) -> Optional[int]:
+        now = self._now()
+        cost = self._clamp_cost(cost)
+        local = self._local.get(user_id)
+        if local is not None:
+            if now < local.cooldown_until:
+                return int(local.cooldown_until - now) + 1
+            if local.tokens > 0 and local.cost >= cost and now < local.expires_at:
+                local.tokens -= 1
+                local.cost -= cost
+                return None
+
+        try:
+            wait, extra, extra_cost = await self._reserve(user_id, cost)
+        except Exception as e:
+            # хранилище недоступно — не роняем бота, но и не пускаем без лимита:
+            # откатываемся на локальный лимит этого процесса
+            logging.warning("rate limit: общее хранилище недоступно (%s), локальный лимит", e)
+            return self._fallback.check(user_id, cost)
 
-    @staticmethod
-    def _prune(q: Deque[float], window: int, now: float) -> None:
-        while q and (now - q[0]) > window:
-            q.popleft()
+        if local is None:
+            local = self._local[user_id] = _Lease()
+        if wait is not None:
+            # cooldown за флуд запоминаем; нехватку бюджета — нет, он восстанавливается сам
+            local.tokens = 0
+            local.cost = 0.0
+            if wait >= self.cfg.cooldown_seconds:
+                local.cooldown_until = now + wait
+        else:
+            local.tokens = extra
+            local.cost = extra_cost
+            local.expires_at = now + self.cfg.per_seconds
+        return wait
 
-    def check(self, user_id: int, is_ai: bool) -> Optional[int]:
+    def _sweep_local(self) -> None:
         now = self._now()
+        stale = [uid for uid, lease in self._local.items()
+                 if lease.cooldown_until <= now and (lease.tokens <= 0 or lease.expires_at <= now)]
+        for uid in stale:
+            del self._local[uid]
 
-        cd = self._cooldown_until.get(user_id)
-        if cd and now < cd:
-            return int(cd - now) + 1
+    async def _sweep_store(self) -> None:
+        """Чистка хранилища (если ему это нужно)."""
 
-        q = self._get_deque(self._bucket, user_id)
-        self._prune(q, self.cfg.per_seconds, now)
-        if len(q) >= self.cfg.max_messages:
-            self._cooldown_until[user_id] = now + self.cfg.cooldown_seconds
-            return self.cfg.cooldown_seconds
+    async def run_sweeper(self) -> None:
+        while True:
+            await asyncio.sleep(self.cfg.sweep_seconds)
+            self._sweep_local()
+            try:
+                await self._sweep_store()
+            except Exception as e:
+                logging.warning("rate limit: очистка хранилища не удалась: %s", e)
 
-        if is_ai:
-            qa = self._get_deque(self._bucket_ai, user_id)
-            self._prune(qa, self.cfg.ai_per_seconds, now)
-            if len(qa) >= self.cfg.max_ai_messages:
-                self._cooldown_until[user_id] = now + self.cfg.cooldown_seconds
-                return self.cfg.cooldown_seconds
 
-        q.append(now)
-        if is_ai:
-            self._get_deque(self._bucket_ai, user_id).append(now)
+class _Lease:
+    """Локальный кэш общего лимитера: выданный запас и известный cooldown."""
+    __slots__ = ("tokens", "cost", "expires_at", "cooldown_until")
 
-        return None
+    def __init__(self):
+        self.tokens = 0
+        self.cost = 0.0
+        self.expires_at = 0.0
+        self.cooldown_until = 0.0
 
 
-class AntiFloodMiddleware(BaseMiddleware):
-    def __init__(self, limiter: InMemoryRateLimiter):
-        super().__init__()
-        self.limiter = limiter
+WindowState = Tuple[Tuple[float, ...], float, float]
 
-    @staticmethod
-    def _looks_ai_heavy(text: str) -> bool:
-        t = (text or "").strip().lower()
-        if not t:
-            return False
 
-        fact_words = ("когда", "где", "кто", "сколько", "дата", "год", "умер", "умерла", "родился", "родилась")
-        if len(t) <= 40 and any(w in t for w in fact_words):
-            return False
+def _window_reserve(
+    st: WindowState,
+    now: float,
+    cost: float,
+    lim: _Limits,
+) -> Tuple[WindowState, Optional[int], int, float]:
+    """
+    Окно над (метки принятых сообщений от старых к новым, tat_cost, cooldown_until) —
+    то же, что InMemoryRateLimiter.check, плюс запас.
+    -> (новое состояние, ждать сек | None, сообщений про запас, бюджета про запас)
+    """
+    stamps, tat_cost, cooldown_until = st
+    if now < cooldown_until:
+        return st, int(cooldown_until - now) + 1, 0, 0.0
+
+    live = [t for t in stamps if now - t <= lim._window]
+    if len(live) >= lim._size:
+        return (tuple(live), tat_cost, now + lim.cfg.cooldown_seconds), lim.cfg.cooldown_seconds, 0, 0.0
+
+    tat_cost = max(tat_cost, now)
+    if cost:
+        new_cost = tat_cost + cost * lim._interval_cost
+        over = new_cost - now - lim._cost_window
+        if over > _EPS:
+            return st, int(over) + 1, 0, 0.0
+        tat_cost = new_cost
+
+    live.append(now)
+    # запас — только если после него в окне остаётся хотя бы одно место
+    extra = max(0, min(lim.cfg.lease_tokens, lim._size - len(live) - 1))
+    extra_cost = 0.0
+    if extra:
+        live.extend([now] * extra)
+        # ...и половина свободного бюджета
+        free_cost = (lim._cost_window - (tat_cost - now)) / lim._interval_cost
+        extra_cost = max(0.0, min(float(lim.cfg.lease_cost_tokens), free_cost / 2))
+        tat_cost += extra_cost * lim._interval_cost
+    return (tuple(live), tat_cost, cooldown_until), None, extra, extra_cost
+
+
+class SQLiteRateLimiter(SharedRateLimiter):
+    """
+    Общее состояние в SQLite (WAL): все процессы на одном хосте / общем диске.
+    Проверка — одна транзакция BEGIN IMMEDIATE в отдельном потоке, event loop не ждёт блокировку.
+    """
+
+    def __init__(self, cfg: RateLimitConfig, path: str):
+        super().__init__(cfg)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # user_limits — состояние прежнего GCRA по сообщениям; оно короткоживущее, не переносим
+        self._conn.execute("DROP TABLE IF EXISTS user_limits")
+        # stamps — метки окна через пробел, last_at — самая свежая из них (для очистки)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_windows ("
+            "user_id INTEGER PRIMARY KEY, stamps TEXT NOT NULL, last_at REAL NOT NULL, "
+            "tat_cost REAL NOT NULL, cooldown_until REAL NOT NULL)"
+        )
+
+    def _reserve_sync(self, user_id: int, cost: float) -> Tuple[Optional[int], int, float]:
+        with self._db_lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                row = cur.execute(
+                    "SELECT stamps, tat_cost, cooldown_until FROM user_windows WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                prev: WindowState = (
+                    (tuple(float(t) for t in row[0].split()), row[1], row[2]) if row else ((), 0.0, 0.0)
+                )
+                st, wait, extra, extra_cost = _window_reserve(prev, self._now(), cost, self)
+                if st != prev:
+                    stamps, tat_cost, cooldown_until = st
+                    cur.execute(
+                        "INSERT OR REPLACE INTO user_windows (user_id, stamps, last_at, tat_cost, cooldown_until) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (user_id, " ".join(map(repr, stamps)), stamps[-1] if stamps else 0.0, tat_cost, cooldown_until),
+                    )
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return wait, extra, extra_cost
+
+    async def _reserve(self, user_id: int, cost: float) -> Tuple[Optional[int], int, float]:
+        return await asyncio.to_thread(self._reserve_sync, user_id, cost)
+
+    def _sweep_sync(self) -> int:
+        now = self._now()
+        with self._db_lock:
+            cur = self._conn.execute(
+                "DELETE FROM user_windows WHERE last_at < ? AND tat_cost <= ? AND cooldown_until <= ?",
+                (now - self._window, now, now),
+            )
+            return cur.rowcount
+
+    async def _sweep_store(self) -> None:
+        await asyncio.to_thread(self._sweep_sync)
+
+
+# Окно на стороне Redis (тот же _window_reserve): проверка и запись атомарны (скрипт
+# выполняется целиком), время — TIME сервера, ключ живёт, пока состояние не вернулось к пустому.
+_REDIS_WINDOW = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local window, size = tonumber(ARGV[1]), tonumber(ARGV[2])
+local interval_cost, cost_window = tonumber(ARGV[3]), tonumber(ARGV[4])
+local cooldown, cost, eps = tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+local lease, lease_cost = tonumber(ARGV[8]), tonumber(ARGV[9])
+
+local st = redis.call('HMGET', KEYS[1], 'ts', 'tat_cost', 'cd')
+local tat_cost = tonumber(st[2]) or 0
+local cd = tonumber(st[3]) or 0
+
+local function save(ts)
+    local last = ts[#ts] or 0
+    redis.call('HSET', KEYS[1], 'ts', table.concat(ts, ' '), 'tat_cost', tostring(tat_cost), 'cd', tostring(cd))
+    local ttl = math.max(last + window, tat_cost, cd) - now
+    redis.call('PEXPIRE', KEYS[1], math.max(1, math.ceil(ttl * 1000)))
+end
+
+if now < cd then
+    return {math.floor(cd - now) + 1, 0, '0'}
+end
+
+local ts = {}
+for s in string.gmatch(st[1] or '', '%S+') do
+    local v = tonumber(s)
+    if v and now - v <= window then
+        table.insert(ts, v)
+    end
+end
+
+if #ts >= size then
+    cd = now + cooldown
+    save(ts)
+    return {cooldown, 0, '0'}
+end
+
+tat_cost = math.max(tat_cost, now)
+if cost > 0 then
+    local new_cost = tat_cost + cost * interval_cost
+    local over = new_cost - now - cost_window
+    if over > eps then
+        return {math.floor(over) + 1, 0, '0'}
+    end
+    tat_cost = new_cost
+end
+
+table.insert(ts, now)
+local extra = math.max(0, math.min(lease, size - #ts - 1))
+local extra_cost = 0
+if extra > 0 then
+    for _ = 1, extra do
+        table.insert(ts, now)
+    end
+    local free_cost = (cost_window - (tat_cost - now)) / interval_cost
+    extra_cost = math.max(0, math.min(lease_cost, free_cost / 2))
+    tat_cost = tat_cost + extra_cost * interval_cost
+end
+save(ts)
+-- дробные числа Redis обрезает до целых — бюджет отдаём строкой
+return {-1, extra, tostring(extra_cost)}
+"""
+
 
-        creative = ("стих", "рассказ", "эссе", "в стиле", "перепиши", "продолжи", "придумай", "поясни", "объясни")
-        if any(w in t for w in creative):
-            return True
+class RedisRateLimiter(SharedRateLimiter):
+    """
+    Общее состояние в Redis (или любом сервере с протоколом Redis и Lua — KeyDB, Dragonfly,
+    локальная заглушка в тестах): лимит держится между хостами. Нужен пакет redis (pip install redis).
+    Ключи сами истекают, чистить хранилище не нужно.
+    """
 
-        return len(t) > 120
+    def __init__(self, cfg: RateLimitConfig, url: str, prefix: str = "rl:"):
+        super().__init__(cfg)
+        try:
+            from redis import asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("Для RATE_LIMIT_BACKEND=redis установи пакет redis") from e
+        self.prefix = prefix
+        self._client = redis_asyncio.Redis.from_url(url)
+        self._script = self._client.register_script(_REDIS_WINDOW)
+
+    async def _reserve(self, user_id: int, cost: float) -> Tuple[Optional[int], int, float]:
+        wait, extra, extra_cost = await self._script(
+            keys=[f"{self.prefix}{user_id}"],
+            args=[
+                self._window, self._size, self._interval_cost, self._cost_window,
+                self.cfg.cooldown_seconds, cost, _EPS,
+                self.cfg.lease_tokens, self.cfg.lease_cost_tokens,
+            ],
+        )
+        wait = int(wait)
+        return (None if wait < 0 else wait), int(extra), float(extra_cost)
+
+
+def build_rate_limiter(cfg: RateLimitConfig, backend: str = "memory", **options):
+    """
+    memory — локально в процессе (один инстанс);
+    sqlite — общий файл SQLite (options: path); redis — общий Redis (options: url).
+    """
+    backend = (backend or "memory").strip().lower()
+    if backend == "sqlite":
+        return SQLiteRateLimiter(cfg, options.get("path") or os.path.join("data", "rate_limit.sqlite3"))
+    if backend == "redis":
+        return RedisRateLimiter(cfg, options.get("url") or "redis://localhost:6379/0")
+    return InMemoryRateLimiter(cfg)
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """
+    Антифлуд для сообщений: каждое сообщение списывает из лимита свою оценочную
+    стоимость для модели. upstream_mode(user_id) говорит, куда уйдёт текст:
+    "chat" / "cowrite" / None (до модели не дойдёт — платим только за само сообщение);
+    может быть корутиной.
+    """
+
+    def __init__(self, limiter, upstream_mode: Optional[Callable[[int], Optional[str]]] = None,
+                 model: str = "GigaChat:latest"):
+        super().__init__()
+        self.limiter = limiter
+        self.upstream_mode = upstream_mode
+        self.model = model
+
+    async def _cost(self, user_id: int, text: str) -> float:
+        if not text or text.startswith("/"):
+            return 0.0
+        mode = self.upstream_mode(user_id) if self.upstream_mode else "chat"
+        if inspect.isawaitable(mode):
+            mode = await mode
+        return estimate_cost(text, mode, self.model)
 
     async def __call__(self, handler, event, data):
         if isinstance(event, Message) and event.from_user:
             user_id = event.from_user.id
-            is_ai = self._looks_ai_heavy(event.text or "")
-            wait = self.limiter.check(user_id, is_ai=is_ai)
+            cost = await self._cost(user_id, (event.text or "").strip())
+            wait = self.limiter.check(user_id, cost)
+            if inspect.isawaitable(wait):
+                wait = await wait
             if wait is not None:
                 await event.answer(f"⏳ Слишком часто. Подожди ~{wait} сек и попробуй снова.")
                 return
         return await handler(event, data)
+
+
+class CallbackFloodMiddleware(BaseMiddleware):
+    """
+    Антифлуд для нажатий кнопок.
+
+    1. Повтор: то же callback.data от того же пользователя, пока первое нажатие ещё
+       обрабатывается или в пределах duplicate_click_seconds после него, отбрасывается
+       молча — до любых чтений/записей и запросов к Telegram.
+    2. Лимит: нажатие списывается из того же лимита, что и сообщения, со стоимостью
+       action_cost(user_id, data) — навигация бесплатна, кнопка, запускающая запрос
+       к модели (сравнение, ответ на отложенный вопрос), стоит как этот запрос
+       (action_cost может быть корутиной).
+    """
+
+    def __init__(self, limiter, action_cost: Optional[Callable[[int, str], float]] = None):
+        super().__init__()
+        self.limiter = limiter
+        self.action_cost = action_cost
+        self.window = float(getattr(limiter.cfg, "duplicate_click_seconds", 1.5))
+        # user_id -> (data, когда закончилась обработка | None, пока идёт)
+        self._last: Dict[int, Tuple[str, Optional[float]]] = {}
+        self._prune_at = 1024
+
+    def _is_duplicate(self, user_id: int, data: str, now: float) -> bool:
+        last = self._last.get(user_id)
+        if last is None or last[0] != data:
+            return False
+        done_at = last[1]
+        return done_at is None or now - done_at < self.window
+
+    def _prune(self, now: float) -> None:
+        stale = [uid for uid, (_d, done_at) in self._last.items()
+                 if done_at is not None and now - done_at >= self.window]
+        for uid in stale:
+            del self._last[uid]
+        self._prune_at = max(1024, 2 * len(self._last))
+
+    async def __call__(self, handler, event, data):
+        if not (isinstance(event, CallbackQuery) and event.from_user):
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        cb_data = event.data or ""
+        now = time.monotonic()
+        if self._is_duplicate(user_id, cb_data, now):
+            return None
+        if len(self._last) >= self._prune_at:
+            self._prune(now)
+        self._last[user_id] = (cb_data, None)
+
+        try:
+            cost = self.action_cost(user_id, cb_data) if self.action_cost else 0.0
+            if inspect.isawaitable(cost):
+                cost = await cost
+            wait = self.limiter.check(user_id, cost)
+            if inspect.isawaitable(wait):
+                wait = await wait
+            if wait is not None:
+                await event.answer(f"⏳ Слишком часто. Подожди ~{wait} сек.")
+                return None
+            return await handler(event, data)
+        finally:
+            if self._last.get(user_id, ("", None))[0] == cb_data:
+                self._last[user_id] = (cb_data, time.monotonic())
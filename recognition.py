@@ -8,10 +8,13 @@
 # Кандидаты фильтруются по list_author_keys(), чтобы не предлагать авторов, которых нет в authors.py
 
 import re
+from typing import Dict, Iterator, List, Tuple
+
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
 
 from authors import get_author, list_author_keys
+from catalog import CATALOG_PATH, CatalogRow, PhraseTrie, load_trie, read_catalog, source_stamp
 
 
 def _norm(s: str) -> str:
@@ -22,13 +25,6 @@ def _norm(s: str) -> str:
     return s
 
 
-def _contains_phrase(text_norm: str, phrase_norm: str) -> bool:
-    if not phrase_norm:
-        return False
-    pattern = r"(?:^|\s)" + re.escape(phrase_norm) + r"(?:$|\s)"
-    return re.search(pattern, text_norm) is not None or phrase_norm in text_norm
-
-
 # --- 1) Автор по фамилии/имени (самое надёжное) ---
 AUTHOR_NAME_HINTS = {
     # Ключи должны совпадать с authors.py (если нет — они отфильтруются автоматически)
@@ -55,172 +51,200 @@ AUTHOR_NAME_HINTS = {
 }
 
 
-# --- 2) Произведение -> автор ---
-# Можно расширять хоть до 500 — алгоритм выдержит.
-WORK_TO_AUTHOR = {
-    # ПУШКИН
-    "капитанская дочка": "pushkin",
-    "евгений онегин": "pushkin",
-    "пиковая дама": "pushkin",
-    "дубровский": "pushkin",
-    "борис годунов": "pushkin",
-    "повести белкина": "pushkin",
-    "выстрел": "pushkin",
-    "метель": "pushkin",
-    "гробовщик": "pushkin",
-    "станционный смотритель": "pushkin",
-    "барышня крестьянка": "pushkin",
-    "медный всадник": "pushkin",
-    "руслан и людмила": "pushkin",
-    "сказка о рыбаке и рыбке": "pushkin",
-    "сказка о царе салтане": "pushkin",
-    "сказка о мертвой царевне и семи богатырях": "pushkin",
-
-    # ЛЕРМОНТОВ
-    "герой нашего времени": "lermontov",
-    "мцыри": "lermontov",
-    "демон": "lermontov",
-    "парус": "lermontov",
-    "бородино": "lermontov",
-
-    # ГОГОЛЬ
-    "мертвые души": "gogol",
-    "ревизор": "gogol",
-    "шинель": "gogol",
-    "нос": "gogol",
-    "вий": "gogol",
-    "тарас бульба": "gogol",
-    "вечера на хуторе близ диканьки": "gogol",
-    "сорочинская ярмарка": "gogol",
-    "ночь перед рождеством": "gogol",
-
-    # ДОСТОЕВСКИЙ
-    "преступление и наказание": "dostoevsky",
-    "братья карамазовы": "dostoevsky",
-    "идиот": "dostoevsky",
-    "бесы": "dostoevsky",
-    "униженные и оскорбленные": "dostoevsky",
-    "записки из подполья": "dostoevsky",
-
-    # ТОЛСТОЙ
-    "война и мир": "tolstoy",
-    "анна каренина": "tolstoy",
-    "воскресение": "tolstoy",
-    "детство": "tolstoy",
-    "отрочество": "tolstoy",
-    "юность": "tolstoy",
-    "после бала": "tolstoy",
-    "кавказский пленник": "tolstoy",
-    "холстомер": "tolstoy",
-
-    # ЧЕХОВ
-    "вишневый сад": "chekhov",
-    "вишнёвый сад": "chekhov",
-    "три сестры": "chekhov",
-    "палата 6": "chekhov",
-    "палата №6": "chekhov",
-    "человек в футляре": "chekhov",
-    "хамелеон": "chekhov",
-    "толстый и тонкий": "chekhov",
-    "дама с собачкой": "chekhov",
-    "ионыч": "chekhov",
-
-    # СЕРЕБРЯНЫЙ ВЕК
-    "реквием": "akhmatova",
-    "поэма без героя": "akhmatova",
-    "двенадцать": "blok",
-    "незнакомка": "blok",
-    "исповедь хулигана": "yesenin",
-    "персидские мотивы": "yesenin",
-    "облако в штанах": "mayakovsky",
-    "флейта позвоночник": "mayakovsky",
-    "флейта-позвоночник": "mayakovsky",
-
-    # БУЛГАКОВ
-    "мастер и маргарита": "bulgakov",
-    "собачье сердце": "bulgakov",
-    "белая гвардия": "bulgakov",
-    "морфий": "bulgakov",
-
-    # ШОЛОХОВ
-    "тихий дон": "sholokhov",
-    "судьба человека": "sholokhov",
-
-    # ФИЛАТОВ
-    "про федота стрельца": "filatov",
-    "про федота стрельца удалого молодца": "filatov",
-
-    # ПЕЛЕВИН (часто спрашивают)
-    "generation п": "pelevin",
-    "generation «п»": "pelevin",
-    "generation p": "pelevin",
-    "чапаев и пустота": "pelevin",
-}
-
-# --- 3) Герой -> автор ---
-# Только "сигнатурные" герои: чтобы не ловить случайные совпадения.
-HERO_TO_AUTHOR = {
-    # Пушкин
-    "гринев": "pushkin",
-    "гринёв": "pushkin",
-    "пугачев": "pushkin",
-    "пугачёв": "pushkin",
-    "маша миронова": "pushkin",
-    "швабрин": "pushkin",
-    "онегин": "pushkin",
-    "ленский": "pushkin",
-    "татьяна ларина": "pushkin",
-    "германн": "pushkin",
-
-    # Лермонтов
-    "печорин": "lermontov",
-    "максим максимыч": "lermontov",
-    "бэла": "lermontov",
-
-    # Гоголь
-    "чичиков": "gogol",
-    "манилов": "gogol",
-    "собакевич": "gogol",
-    "плюшкин": "gogol",
-    "хлестаков": "gogol",
-    "акакий акакиевич": "gogol",
-
-    # Достоевский
-    "раскольников": "dostoevsky",
-    "соня мармеладова": "dostoevsky",
-    "свидригайлов": "dostoevsky",
-    "порфирий петрович": "dostoevsky",
-    "князь мышкин": "dostoevsky",
-    "настья филипповна": "dostoevsky",
-
-    # Толстой
-    "пьер безухов": "tolstoy",
-    "андрей болконский": "tolstoy",
-    "наташа ростова": "tolstoy",
-    "анна каренина": "tolstoy",
-    "вронский": "tolstoy",
-    "левин": "tolstoy",
-
-    # Чехов
-    "беликов": "chekhov",
-
-    # Булгаков
-    "воланд": "bulgakov",
-    "маргарита": "bulgakov",
-    "шариков": "bulgakov",
-    "преображенский": "bulgakov",
-
-    # Шолохов
-    "мелехов": "sholokhov",
-
-    # Филатов
-    "федот": "filatov",
-}
+# --- 2) Произведение -> автор, 3) Герой -> автор ---
+# Живут в файле данных catalog/works.tsv (см. catalog.py): там могут быть десятки тысяч
+# строк. Герои — только "сигнатурные", чтобы не ловить случайные совпадения.
 
 # Короткие названия — только точной фразой
 SHORT_TITLES_RISK = {"ася", "нос", "вий", "парус", "бородино", "морфий", "ионыч"}
 
 
+# =========================
+# Фамилии авторов + каталог — в одно компактное префиксное дерево, текст проходим один раз
+# =========================
+def _catalog_rows() -> Iterator[CatalogRow]:
+    # 1) фамилия автора
+    for hint, akey in AUTHOR_NAME_HINTS.items():
+        yield "author", akey, _norm(hint), False
+
+    # 2) произведения и 3) герои; короткие названия — только точной фразой
+    for kind, akey, phrase, exact in read_catalog():
+        p = _norm(phrase)
+        yield kind, akey, p, exact or (kind == "work" and p in SHORT_TITLES_RISK)
+
+
+def _load_matcher() -> PhraseTrie:
+    # подсказки и SHORT_TITLES_RISK живут в коде — правка любого из них тоже пересобирает кэш
+    stamp = source_stamp(CATALOG_PATH, AUTHOR_NAME_HINTS, SHORT_TITLES_RISK)
+    return load_trie(_catalog_rows, stamp)
+
+
+_MATCHER = _load_matcher()
+
+
+def _phrase_score(pid: int) -> Tuple[int, str]:
+    kind = _MATCHER.kind(pid)
+    if kind == "author":
+        return 110, "узнал автора по фамилии/упоминанию"
+    if kind == "hero":
+        return 95, "похоже по персонажу произведения"
+    if _MATCHER.is_exact(pid):
+        return 85, "похоже по названию произведения (точное совпадение)"
+    return 65 + min(_MATCHER.ph_len[pid], 45), "похоже по названию произведения"
+
+
+# =========================
+# Опечатки: триграммный индекс + ограниченное расстояние Левенштейна
+# =========================
+# Нечёткий поиск только для названий и героев длиной от 5 букв: на коротких словах
+# одна опечатка превращает их в другие обычные слова.
+FUZZY_MIN_LEN = 5
+FUZZY_MIN_DICE = 0.45
+FUZZY_PENALTY = 10          # минус к очкам за каждую правку
+FUZZY_MIN_SCORE = 65
+FUZZY_MAX_TEXT_WORDS = 60
+FUZZY_CACHE_SIZE = 20000    # слово текста -> похожие слова словаря
+
+
+def _max_edits(length: int) -> int:
+    return 1 if length <= 7 else 2
+
+
+def _trigrams(phrase: str) -> set:
+    padded = f" {phrase} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _bounded_levenshtein(a: str, b: str, max_dist: int) -> int:
+    """
+    Расстояние Левенштейна, но не больше max_dist + 1 (дальше считать незачем).
+    """
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        row_min = i
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb))
+            if cur[j] < row_min:
+                row_min = cur[j]
+        if row_min > max_dist:
+            return max_dist + 1
+        prev = cur
+    return prev[-1]
+
+
+class FuzzyIndex:
+    """
+    Нечёткий поиск по словам: для каждого слова текста находим похожие слова словаря
+    (триграммы -> коэффициент Дайса -> ограниченный Левенштейн, результат кэшируется),
+    затем собираем из них фразы, начиная с первого слова фразы.
+    Сумма правок по фразе ограничена так же, как для одного слова той же длины.
+    """
+
+    def __init__(self, trie: PhraseTrie):
+        # тексты фраз берём из дерева каталога, здесь — только их phrase_id
+        self._trie = trie
+        self._by_first_word: Dict[str, List[int]] = {}
+        self._vocab_grams: Dict[str, int] = {}
+        self._gram_index: Dict[str, List[str]] = {}
+        self._similar_cache: Dict[str, Tuple[Tuple[str, int], ...]] = {}
+
+    def add(self, pid: int) -> None:
+        phrase = self._trie.phrase(pid)
+        if len(phrase) < FUZZY_MIN_LEN:
+            return
+        words = phrase.split()
+        self._by_first_word.setdefault(words[0], []).append(pid)
+        for w in words:
+            if w in self._vocab_grams:
+                continue
+            grams = _trigrams(w)
+            self._vocab_grams[w] = len(grams)
+            for g in grams:
+                self._gram_index.setdefault(g, []).append(w)
+
+    def _similar(self, word: str) -> Tuple[Tuple[str, int], ...]:
+        """Слова словаря на расстоянии не больше допустимого: ((слово, правок), ...)."""
+        cached = self._similar_cache.get(word)
+        if cached is not None:
+            return cached
+
+        out: List[Tuple[str, int]] = []
+        if word in self._vocab_grams:
+            out.append((word, 0))
+        # короткие слова — только точно: "нос" -> "нас" уже не опечатка, а другое слово
+        if len(word) >= FUZZY_MIN_LEN - 1:
+            grams = _trigrams(word)
+            common: Dict[str, int] = {}
+            for g in grams:
+                for w in self._gram_index.get(g, ()):
+                    common[w] = common.get(w, 0) + 1
+            for w, cnt in common.items():
+                if w == word:
+                    continue
+                max_dist = _max_edits(len(w))
+                if abs(len(w) - len(word)) > max_dist:
+                    continue
+                if 2.0 * cnt / (self._vocab_grams[w] + len(grams)) < FUZZY_MIN_DICE:
+                    continue
+                dist = _bounded_levenshtein(word, w, max_dist)
+                if dist <= max_dist:
+                    out.append((w, dist))
+
+        result = tuple(out)
+        if len(self._similar_cache) >= FUZZY_CACHE_SIZE:
+            self._similar_cache.clear()
+        self._similar_cache[word] = result
+        return result
+
+    def iter_matches(self, text_norm: str) -> Iterator[Tuple[int, int]]:
+        """(phrase_id, правок) для фраз, найденных с опечатками."""
+        words = text_norm.split()[:FUZZY_MAX_TEXT_WORDS]
+        similar = [dict(self._similar(w)) for w in words]
+
+        for start, first in enumerate(similar):
+            for vocab_word, first_dist in first.items():
+                for pid in self._by_first_word.get(vocab_word, ()):
+                    phrase = self._trie.phrase(pid)
+                    phrase_words = phrase.split()
+                    max_dist = _max_edits(len(phrase))
+                    if start + len(phrase_words) > len(words):
+                        continue
+                    dist = first_dist
+                    for offset in range(1, len(phrase_words)):
+                        d = similar[start + offset].get(phrase_words[offset])
+                        if d is None and len(phrase_words[offset]) < FUZZY_MIN_LEN - 1:
+                            # короткое слово внутри фразы ("вишнёвый сат"): одна правка,
+                            # считаем только здесь — первое слово фразы уже совпало
+                            d = _bounded_levenshtein(words[start + offset], phrase_words[offset], 1)
+                            d = d if d <= 1 else None
+                        if d is None:
+                            dist = max_dist + 1
+                            break
+                        dist += d
+                    # 0 правок — это точное совпадение, его уже нашёл точный проход
+                    if 0 < dist <= max_dist:
+                        yield pid, dist
+
+
+_FUZZY = None
+
+
+def _get_fuzzy() -> FuzzyIndex:
+    # строится при первом запросе: старт бота не ждёт словаря опечаток по всему каталогу
+    global _FUZZY
+    if _FUZZY is None:
+        f = FuzzyIndex(_MATCHER)
+        for pid in range(len(_MATCHER)):
+            # фамилии авторов и exact-фразы (SHORT_TITLES_RISK и т.п.) — только точно
+            if _MATCHER.kind(pid) != "author" and not _MATCHER.is_exact(pid):
+                f.add(pid)
+        _FUZZY = f
+    return _FUZZY
+
+
 def guess_authors_from_text(user_text: str, limit: int = 3):
     """
     Возвращает список кандидатов:
@@ -235,37 +259,17 @@ def guess_authors_from_text(user_text: str, limit: int = 3):
     def add_score(akey: str, score: int, reason: str):
         if akey not in available:
             return
-        prev = scores.get(akey, 0)
-        if score > prev:
+        if score > scores.get(akey, 0):
             scores[akey] = score
             reasons[akey] = reason
 
-    # 1) фамилия автора
-    for hint, akey in AUTHOR_NAME_HINTS.items():
-        h = _norm(hint)
-        if h and _contains_phrase(text_norm, h):
-            add_score(akey, 110, "узнал автора по фамилии/упоминанию")
-
-    # 2) произведение
-    for title, akey in WORK_TO_AUTHOR.items():
-        t = _norm(title)
-        if not t:
-            continue
-
-        if t in SHORT_TITLES_RISK:
-            if _contains_phrase(text_norm, t):
-                add_score(akey, 85, "похоже по названию произведения (точное совпадение)")
-            continue
-
-        if t in text_norm:
-            score = 65 + min(len(t), 45)
-            add_score(akey, score, "похоже по названию произведения")
-
-    # 3) герой
-    for hero, akey in HERO_TO_AUTHOR.items():
-        h = _norm(hero)
-        if h and _contains_phrase(text_norm, h):
-            add_score(akey, 95, "похоже по персонажу произведения")
+    for pid in _MATCHER.iter_matches(text_norm):
+        add_score(_MATCHER.author(pid), *_phrase_score(pid))
+
+    # точное совпадение всегда весомее: у нечёткого очки ниже на штраф за правки
+    for pid, dist in _get_fuzzy().iter_matches(text_norm):
+        score, reason = _phrase_score(pid)
+        add_score(_MATCHER.author(pid), max(FUZZY_MIN_SCORE, score - FUZZY_PENALTY * dist), reason + " (с опечаткой)")
 
     res = []
     for akey, score in scores.items():
@@ -0,0 +1,225 @@
+# sharding.py
+# Несколько процессов-обработчиков вместо одного: один приёмник апдейтов, N воркеров.
+#
+# Приёмник (long polling через getUpdates или вебхук на aiohttp) ничего не разбирает, кроме
+# id пользователя: апдейт уходит воркеру user_id % N. Один пользователь всегда попадает
+# в один и тот же воркер, поэтому порядок его апдейтов сохраняется (внутри воркера — очередь
+# на пользователя, см. user_queue.py), а его user_{id}.json и антифлуд живут в одном процессе.
+# Воркеры — полноценные Dispatcher'ы со своим Bot, отвечают в Telegram сами.
+#
+# Общие для всех файлы (users.json, stats.json) main.py копит в памяти воркера и раз в несколько
+# секунд сливает в потоке под файловой блокировкой.
+#
+# Команды, которым нужно общее состояние процесса, а не пользователя (рассылки живут в воркере 0:
+# только он продолжает их после рестарта), приёмник отправляет в воркер 0 — pinned_commands.
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue as queue_mod
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))
+
+# где в апдейте лежит пользователь
+_USER_KEYS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "my_chat_member", "chat_member", "chat_join_request", "pre_checkout_query", "shipping_query",
+    "poll_answer", "business_message", "message_reaction",
+)
+
+
+def update_user_id(update: Dict[str, Any]) -> int:
+    """id пользователя (или чата) из сырого апдейта; 0 — не нашли (такие идут в воркер 0)."""
+    for key in _USER_KEYS:
+        obj = update.get(key)
+        if not obj:
+            continue
+        user = obj.get("from") or obj.get("user")
+        if user and "id" in user:
+            return int(user["id"])
+        chat = obj.get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+    return 0
+
+
+def update_command(update: Dict[str, Any]) -> Optional[str]:
+    """"/command" из текста сообщения (без @botname) или None."""
+    text = (update.get("message") or {}).get("text") or ""
+    if not text.startswith("/"):
+        return None
+    return text.split(maxsplit=1)[0].split("@", 1)[0]
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    # id в Telegram — последовательные числа, простого остатка достаточно для равномерности
+    return abs(int(user_id)) % max(1, workers)
+
+
+class ShardRouter:
+    """Приёмник: раскладывает сырые апдейты по очередям воркеров."""
+
+    def __init__(self, queues: List[Any], pinned_commands: Iterable[str] = ()):
+        self.queues = queues
+        self.pinned_commands = frozenset(pinned_commands)
+        self.routed = [0] * len(queues)
+        self.dropped = 0
+
+    def route(self, update: Dict[str, Any]) -> None:
+        if self.pinned_commands and update_command(update) in self.pinned_commands:
+            shard = 0
+        else:
+            shard = shard_for(update_user_id(update), len(self.queues))
+        try:
+            self.queues[shard].put_nowait(update)
+            self.routed[shard] += 1
+        except queue_mod.Full:
+            # воркер не успевает — лучше потерять апдейт, чем раздуть память приёмника
+            self.dropped += 1
+            logger.warning("shard %s: очередь полна, апдейт %s отброшен", shard, update.get("update_id"))
+
+    def metrics(self) -> Dict[str, Any]:
+        depths = []
+        for q in self.queues:
+            try:
+                depths.append(q.qsize())
+            except NotImplementedError:  # macOS
+                depths.append(None)
+        return {"workers": len(self.queues), "routed": list(self.routed), "queue_depth": depths, "dropped": self.dropped}
+
+
+# =========================
+# Воркер
+# =========================
+def _get_batch(q, timeout: float, limit: int = 256) -> List[Any]:
+    """Блокирующе ждёт первый апдейт, затем забирает всё, что уже лежит в очереди."""
+    batch = [q.get(True, timeout)]
+    while len(batch) < limit and batch[-1] is not None:
+        try:
+            batch.append(q.get_nowait())
+        except queue_mod.Empty:
+            break
+    return batch
+
+
+async def consume(q, handle: Callable[[Dict[str, Any]], Any]) -> None:
+    """
+    Читает апдейты из очереди процесса и запускает handle(update) задачей, как делает
+    aiogram при polling; None в очереди — остановка (ждём незавершённые).
+    """
+    loop = asyncio.get_running_loop()
+    parent = mp.parent_process()
+    tasks: set = set()
+    running = True
+    while running:
+        try:
+            # поток ждёт очередь, event loop в это время обрабатывает уже полученное
+            batch = await loop.run_in_executor(None, _get_batch, q, 1.0)
+        except queue_mod.Empty:
+            # приёмник убит без остановки воркеров (SIGKILL, os._exit) — уходим вместе с ним
+            if parent is not None and not parent.is_alive():
+                break
+            continue
+        for update in batch:
+            if update is None:
+                running = False
+                break
+            task = asyncio.create_task(handle(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def start_workers(target: Callable[[int, int, Any], None], workers: int, queue_size: int = SHARD_QUEUE_SIZE):
+    """
+    Запускает workers процессов target(index, workers, queue). spawn, а не fork:
+    приёмник к этому моменту уже держит event loop и сокеты.
+    """
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+    procs = []
+    for i in range(workers):
+        p = ctx.Process(target=target, args=(i, workers, queues[i]), name=f"bot-shard-{i}", daemon=True)
+        p.start()
+        procs.append(p)
+    return queues, procs
+
+
+def stop_workers(queues: List[Any], procs: List[Any], timeout: float = 30.0) -> None:
+    for q in queues:
+        try:
+            q.put(None, timeout=1.0)
+        except Exception:
+            pass
+    deadline = time.monotonic() + timeout
+    for p in procs:
+        p.join(max(0.0, deadline - time.monotonic()))
+        if p.is_alive():
+            p.terminate()
+
+
+# =========================
+# Приёмник
+# =========================
+async def poll_updates(token: str, router: ShardRouter, allowed_updates: Optional[List[str]] = None,
+                       timeout: int = 30) -> None:
+    """Long polling getUpdates напрямую: апдейты не разбираются в модели aiogram, только раскладываются."""
+    url = f"https://api.telegram.org/bot{token}/getUpdates"
+    offset = None
+    backoff = 1.0
+    async with aiohttp.ClientSession() as session:
+        while True:
+            params: Dict[str, Any] = {"timeout": timeout}
+            if offset is not None:
+                params["offset"] = offset
+            if allowed_updates is not None:
+                params["allowed_updates"] = json.dumps(allowed_updates)
+            try:
+                async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout + 10)) as resp:
+                    payload = await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("getUpdates: %s, повтор через %.0f с", e, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(30.0, backoff * 2)
+                continue
+
+            if not payload.get("ok"):
+                retry_after = (payload.get("parameters") or {}).get("retry_after")
+                logger.warning("getUpdates: %s", payload.get("description"))
+                await asyncio.sleep(float(retry_after or backoff))
+                backoff = min(30.0, backoff * 2)
+                continue
+
+            backoff = 1.0
+            for update in payload.get("result", []):
+                offset = int(update["update_id"]) + 1
+                router.route(update)
+
+
+def add_webhook_route(app: web.Application, path: str, secret: str, router: ShardRouter) -> None:
+    """Вебхук приёмника: проверка секрета, раскладка по воркерам, сразу 200."""
+
+    async def receive(request: web.Request) -> web.Response:
+        got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(got, secret):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        router.route(update)
+        return web.Response()
+
+    app.router.add_post(path, receive)
@@ -0,0 +1,190 @@
+# upstream_limiter.py
+# Глобальный адаптивный лимит одновременных запросов к модели (AIMD).
+#
+# Пер-пользовательский антифлуд не спасает, когда активных пользователей много,
+# а GigaChat начинает тормозить или отвечать 429. Здесь — один лимит на процесс:
+# - пока задержка в норме, лимит растёт на 1 за "круг" запросов (additive increase);
+# - на 429 / таймаут / всплеск задержки лимит делится пополам (multiplicative decrease);
+# - запрос, которому не хватило места за queue_timeout, получает UpstreamOverloaded.
+# Текущий лимит, очередь и доля отказов — в metrics().
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Optional, Tuple
+
+
+class UpstreamOverloaded(RuntimeError):
+    """Модель перегружена: свободного слота не дождались."""
+
+
+@dataclass
+class AIMDConfig:
+    initial_limit: float = 4.0
+    min_limit: float = 1.0
+    max_limit: float = 32.0
+    decrease_factor: float = 0.5
+    queue_timeout: float = 20.0          # сколько запрос готов ждать слот
+    max_queue: int = 200                 # длиннее очередь — отказ сразу
+    latency_spike_factor: float = 2.5    # задержка выше базовой во столько раз — "всплеск"
+    latency_spike_min: float = 8.0       # ...но не меньше стольких секунд
+    latency_alpha: float = 0.1           # сглаживание базовой задержки (EWMA)
+    metrics_window: float = 300.0        # окно для доли отказов, сек
+
+    @classmethod
+    def from_env(cls) -> "AIMDConfig":
+        return cls(
+            initial_limit=float(os.getenv("UPSTREAM_INITIAL_LIMIT", cls.initial_limit)),
+            min_limit=float(os.getenv("UPSTREAM_MIN_LIMIT", cls.min_limit)),
+            max_limit=float(os.getenv("UPSTREAM_MAX_LIMIT", cls.max_limit)),
+            queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", cls.queue_timeout)),
+        )
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD-лимит одновременных запросов.
+
+    Использование:
+        await limiter.acquire()            # или acquire(wait=False) для фоновых задач
+        ... запрос ...
+        limiter.release(latency=сек)       # успех
+        limiter.release(overload="429")    # 429 / таймаут — лимит вниз
+        limiter.release()                  # прочая ошибка — лимит не трогаем
+        limiter.note_overload("timeout")   # перегрузка видна раньше, чем освободится слот
+    """
+
+    def __init__(self, cfg: Optional[AIMDConfig] = None):
+        self.cfg = cfg or AIMDConfig()
+        self.limit = float(self.cfg.initial_limit)
+        self.inflight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+        self._latency_ewma: Optional[float] = None
+        self._last_decrease = 0.0
+
+        # события за окно: (время, принят ли)
+        self._events: Deque[Tuple[float, bool]] = deque()
+        self.total_accepted = 0
+        self.total_rejected = 0
+        self.overloads: Dict[str, int] = {}
+
+    # ---------- слоты ----------
+
+    def _has_room(self) -> bool:
+        return self.inflight < int(self.limit)
+
+    async def acquire(self, wait: bool = True) -> None:
+        if self._has_room() and not self._waiters:
+            self.inflight += 1
+            self._record(True)
+            return
+
+        if not wait or len(self._waiters) >= self.cfg.max_queue:
+            self._record(False)
+            raise UpstreamOverloaded("upstream concurrency limit reached")
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.cfg.queue_timeout)
+        except asyncio.TimeoutError:
+            self._record(False)
+            self._return_if_granted(fut)
+            raise UpstreamOverloaded("timed out waiting for upstream slot") from None
+        except BaseException:
+            self._return_if_granted(fut)
+            raise
+        finally:
+            try:
+                self._waiters.remove(fut)
+            except ValueError:
+                pass
+        self._record(True)
+
+    def _return_if_granted(self, fut: asyncio.Future) -> None:
+        # слот могли выдать ровно в момент таймаута/отмены — вернём его
+        if fut.done() and not fut.cancelled():
+            self.inflight -= 1
+            self._wake()
+
+    def release(self, latency: Optional[float] = None, overload: Optional[str] = None) -> None:
+        self.inflight = max(0, self.inflight - 1)
+        if overload:
+            self._decrease(overload)
+        elif latency is not None:
+            self._on_latency(latency)
+        self._wake()
+
+    def note_overload(self, reason: str) -> None:
+        """Лимит вниз сразу, не дожидаясь release (слот ещё занят зависшим запросом)."""
+        self._decrease(reason)
+
+    def _wake(self) -> None:
+        while self._waiters and self._has_room():
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.inflight += 1
+            fut.set_result(None)
+
+    # ---------- AIMD ----------
+
+    def _on_latency(self, latency: float) -> None:
+        base = self._latency_ewma
+        if base is not None and latency > max(self.cfg.latency_spike_min, base * self.cfg.latency_spike_factor):
+            # всплеск не вливаем в базовую задержку, иначе она "привыкнет" к тормозам
+            self._decrease("latency")
+            return
+
+        a = self.cfg.latency_alpha
+        self._latency_ewma = latency if base is None else (1 - a) * base + a * latency
+
+        # растём только когда лимит реально упирается, иначе он уплывёт вверх без проверки
+        if self.inflight + 1 >= int(self.limit) or self._waiters:
+            self.limit = min(self.cfg.max_limit, self.limit + 1.0 / self.limit)
+
+    def _decrease(self, reason: str) -> None:
+        self.overloads[reason] = self.overloads.get(reason, 0) + 1
+        now = time.monotonic()
+        # одна перегрузка даёт пачку ошибок от запросов, ушедших одновременно:
+        # режем не чаще раза за типичное время ответа
+        if now - self._last_decrease < (self._latency_ewma or 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.cfg.min_limit, self.limit * self.cfg.decrease_factor)
+
+    # ---------- метрики ----------
+
+    def _record(self, accepted: bool) -> None:
+        now = time.monotonic()
+        if accepted:
+            self.total_accepted += 1
+        else:
+            self.total_rejected += 1
+        self._events.append((now, accepted))
+        cutoff = now - self.cfg.metrics_window
+        while self._events and self._events[0][0] < cutoff:
+            self._events.popleft()
+
+    def metrics(self) -> Dict[str, Any]:
+        cutoff = time.monotonic() - self.cfg.metrics_window
+        recent = [ok for ts, ok in self._events if ts >= cutoff]
+        rejected = sum(1 for ok in recent if not ok)
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "queued": len(self._waiters),
+            "latency_ewma_s": round(self._latency_ewma, 3) if self._latency_ewma is not None else None,
+            "rejection_rate": round(rejected / len(recent), 4) if recent else 0.0,
+            "window_s": self.cfg.metrics_window,
+            "accepted_total": self.total_accepted,
+            "rejected_total": self.total_rejected,
+            "overloads": dict(self.overloads),
+        }
+
+
+upstream_limiter = AdaptiveConcurrencyLimiter(AIMDConfig.from_env())
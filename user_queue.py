@@ -0,0 +1,161 @@
+# user_queue.py
+# Порядок обработки апдейтов: по одному за раз на пользователя, разные пользователи — параллельно.
+#
+# aiogram обрабатывает апдейты конкурентно (каждый — своей задачей). Хендлер читает
+# user_{id}.json, ждёт ответа модели несколько секунд и пишет файл обратно; второе сообщение
+# или нажатие кнопки того же пользователя в это время читало старое состояние и затирало запись.
+# Здесь на каждого пользователя — своя очередь (asyncio.Lock, FIFO): апдейты одного
+# пользователя идут строго по порядку прихода, а лок существует, только пока очередь не пуста.
+# Слишком длинная очередь у одного пользователя — лишние апдейты отбрасываются сразу,
+# слишком долгое ожидание своей очереди — тоже; в обоих случаях пользователь получает ответ
+# (для кнопки — callback.answer, иначе клиент крутит часики).
+#
+# Middleware внутреннее (dp.message / dp.callback_query) и регистрируется после антифлуда:
+# лимит и повторные нажатия проверяются до очереди, лишнее в неё не попадает.
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+logger = logging.getLogger(__name__)
+
+USER_QUEUE_MAX_PENDING = int(os.getenv("USER_QUEUE_MAX_PENDING", "8"))
+# сколько апдейт может ждать своей очереди, секунд (0 — без ограничения)
+USER_QUEUE_MAX_WAIT = float(os.getenv("USER_QUEUE_MAX_WAIT", "30"))
+
+_BUSY_TEXT = "⏳ Ещё отвечаю на предыдущее — попробуйте чуть позже."
+
+
+class _Slot:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0  # апдейтов пользователя в работе + в очереди
+
+
+def _percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+class PerUserOrderingMiddleware(BaseMiddleware):
+    """
+    Middleware для dp.message и dp.callback_query (один экземпляр на оба — очередь у
+    пользователя общая): сериализует апдейты по event_from_user. Апдейты без пользователя не ждут.
+    """
+
+    def __init__(self, max_pending: int = USER_QUEUE_MAX_PENDING, max_wait: float = USER_QUEUE_MAX_WAIT,
+                 wait_samples: int = 2000):
+        super().__init__()
+        self.max_pending = max(1, max_pending)
+        self.max_wait = max_wait if max_wait > 0 else None
+        self._slots: Dict[int, _Slot] = {}
+        self._waits: Deque[float] = deque(maxlen=wait_samples)
+        self.processed_total = 0
+        self.dropped_total = 0
+        self.timed_out_total = 0
+        self.peak_depth = 0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        uid = user.id
+        slot = self._slots.get(uid)
+        if slot is None:
+            slot = self._slots[uid] = _Slot()
+        if slot.depth >= self.max_pending:
+            self.dropped_total += 1
+            logger.info("user queue: %s — очередь %s, апдейт отброшен", uid, slot.depth)
+            await _reply_busy(event)
+            return None
+
+        slot.depth += 1
+        self.peak_depth = max(self.peak_depth, slot.depth)
+        queued_at = time.monotonic()
+        try:
+            try:
+                await asyncio.wait_for(slot.lock.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self.timed_out_total += 1
+                logger.info("user queue: %s — ждал дольше %s с, апдейт отброшен", uid, self.max_wait)
+                await _reply_busy(event)
+                return None
+            try:
+                self._waits.append(time.monotonic() - queued_at)
+                return await handler(event, data)
+            finally:
+                slot.lock.release()
+        finally:
+            slot.depth -= 1
+            self.processed_total += 1
+            if slot.depth == 0 and self._slots.get(uid) is slot:
+                del self._slots[uid]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id: int):
+        """
+        Занять очередь пользователя вне апдейта — для фоновой правки его файла:
+        ждёт, пока отработают его апдейты, а новые ждут, пока блок не выйдет.
+        """
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _Slot()
+        slot.depth += 1
+        try:
+            async with slot.lock:
+                yield
+        finally:
+            slot.depth -= 1
+            if slot.depth == 0 and self._slots.get(user_id) is slot:
+                del self._slots[user_id]
+
+    def depth(self, user_id: int) -> int:
+        slot = self._slots.get(user_id)
+        return slot.depth if slot is not None else 0
+
+    def metrics(self) -> Dict[str, Any]:
+        depths = [s.depth for s in self._slots.values()]
+        waits = sorted(self._waits)
+        histogram = {"1": 0, "2": 0, "3-4": 0, "5+": 0}
+        for d in depths:
+            key = "1" if d == 1 else "2" if d == 2 else "3-4" if d <= 4 else "5+"
+            histogram[key] += 1
+        return {
+            "users_in_flight": len(depths),
+            "queued_updates": sum(d - 1 for d in depths),
+            "max_depth": max(depths) if depths else 0,
+            "peak_depth": self.peak_depth,
+            "depth_histogram": histogram,
+            "wait_p50_ms": round(_percentile(waits, 50) * 1000, 1),
+            "wait_p99_ms": round(_percentile(waits, 99) * 1000, 1),
+            "processed_total": self.processed_total,
+            "dropped_total": self.dropped_total,
+            "timed_out_total": self.timed_out_total,
+            "max_pending": self.max_pending,
+            "max_wait_s": self.max_wait,
+        }
+
+
+async def _reply_busy(event) -> None:
+    try:
+        # у кнопки это гасит часики на клиенте, у сообщения — обычный ответ в чат
+        if isinstance(event, (CallbackQuery, Message)):
+            await event.answer(_BUSY_TEXT)
+    except Exception as e:
+        logger.debug("user queue: не удалось ответить: %s", e)
+
+
+user_ordering = PerUserOrderingMiddleware()